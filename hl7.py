@@ -11,12 +11,31 @@ import sqlite3
 import base64
 import json
 import time
-from ftplib import FTP
+import random
+import asyncio
+import selectors
+import weakref
+import mmap
+import gzip
+import bz2
+import lzma
+import math
+import zlib
+import threading
+from bisect import bisect_left
+from array import array
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from ftplib import FTP, error_perm, all_errors
+from queue import Queue, Empty
 from io import BytesIO, StringIO
-from os import remove, rename, path, getcwd
+from os import remove, rename, replace, stat, fstat, fsync, makedirs, path, getcwd
 from glob import glob
+from fnmatch import fnmatch
+from collections import OrderedDict, deque
 from uuid import uuid4
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Non-standard libraries
 try:
@@ -745,16 +764,30 @@ class tcp:
 
 	class server():
 		"""Class receives data on a listener port on the local machine"""
+		# Precomputed MLLP fragments for building ACKs
+		SB = b'\x0b'		# <SB>, vertical tab
+		EB = b'\x1c\x0d'	# <EB><CR>, file separator and return
+
 		def __init__(self,port):
 			# Initializes connection object
-			self.largeMsg = []   # A variable to hold large messages
 			self.ackFlag = True
 			self.port = port
 			# Connection variables populated when connection is established
 			self.conn = None
 			self.addr = None
+			self.address = None
+			self.conns = {}
 			self.halt = False
 			self.qFlag = False
+			self.dedupFlag = False
+			self.duplicates = 0	# Count of retransmitted messages suppressed
+			self.throttleFlag = False
+			self.throttled = False
+			self.frames = deque()	# Complete frames waiting to be processed
+			self.durable = False
+			self.unacked = []	# Queued messages waiting on a commit before their ACK
+			self.ready = deque()	# Messages of a committed batch waiting to be passed on
+			self.stats = metrics('tcp_server', port)
 			#self.dbId = self.queue()
 			
 		def queue(self, name='', db=''):
@@ -763,17 +796,162 @@ class tcp:
 			self.pId = None
 			self.qFlag = True
 
+		def batching(self, size=100, interval=.05, durable=True):
+			"""Group commits queued messages, with durable holding each ACK until its commit"""
+			if not self.qFlag:
+				raise RuntimeError('batching() needs a queue, call queue() first')
+			self.q.batching(size, interval)
+			self.durable = durable
+
+		def release(self, sel):
+			"""Commits the pending batch and then ACKs the messages in it"""
+			self.q.flush()
+			if self.dedupFlag:
+				self.remembered(force=True)
+			unacked, self.unacked = self.unacked, []
+			for conn, frame, pId, received in unacked:
+				self.pId = pId
+				try:
+					ACK = self.ack(frame,'AA',conn=conn)
+				except OSError:
+					self.stats.inc('errors')
+					self.drop(sel, conn)
+					continue
+				self.stats.observe('receive_to_ack', time.perf_counter() - received)
+
+		def dedup(self, size=10000, ttl=3600, persist=False, name='', db=''):
+			"""Suppresses messages already received, keyed by sender (MSH-3, MSH-4) and MSH-10"""
+			self.seen = OrderedDict()	# key -> time first seen, oldest first
+			self.seenSize = size
+			self.seenTtl = ttl
+			self.seenDb = None
+			self.seenPending = {}	# key -> time added, or None once expired or evicted
+			self.seenSince = 0
+			if persist:
+				# Keeping seen keys in SQLite so they survive restarts
+				if not name:
+					name = f'DEDUP_{self.port}'
+				self.seenDb = database(name, db)
+				for key, added in self.seenDb.recall(ttl):
+					self.seen[key] = added
+			self.dedupFlag = True
+
+		def duplicate(self,raw):
+			"""Returns True if the message was seen recently, otherwise remembers it"""
+			fields, ret = self.mshFields(raw)
+			if len(fields) < 10 or not fields[9]:
+				return False	# No control id to match on
+			key = b'\r'.join((fields[2], fields[3], fields[9])).decode('utf-8','ignore')
+
+			# Expiring the oldest entries by age
+			now = time.time()
+			seen = self.seen
+			dropped = []
+			while seen and next(iter(seen.values())) < now - self.seenTtl:
+				dropped.append(seen.popitem(last=False)[0])
+
+			if key in seen:
+				self.duplicates += 1
+				self.remembered(dropped)
+				return True
+
+			# Making room for the new key only once we know it is new
+			while len(seen) >= self.seenSize:
+				dropped.append(seen.popitem(last=False)[0])
+			seen[key] = now
+			self.remembered(dropped, key, now)
+			return False
+
+		def remembered(self, dropped=(), key=None, added=None, force=False):
+			"""Writes seen key changes to SQLite, group committed like the queue when there is one"""
+			if not self.seenDb:
+				return
+			pending = self.seenPending
+			if not pending:
+				self.seenSince = time.monotonic()
+			for old in dropped:
+				pending[old] = None
+			if key is not None:
+				pending[key] = added
+			if not pending:
+				return
+			# Buffering here rather than in an open transaction, the queue may share the file
+			if not force and self.qFlag and len(pending) < self.q.batch and time.monotonic() - self.seenSince < self.q.interval:
+				return
+			self.seenDb.remember(pending)
+			self.seenPending = {}
+
+		def throttle(self, high=1000, low=None, reject=False, status='AR', error='Receiver busy, retry later', stall=60):
+			"""Applies backpressure once high messages are waiting, until it drains to low"""
+			# Waiting messages are the unprocessed rows in the queue table, so a queue
+			# consumer (queue.getMsg or getMany) has to drain it. getMsg() here only
+			# passes messages on and never marks rows processed. If the depth doesn't
+			# fall for stall seconds while throttled, getMsg() raises instead of
+			# leaving senders waiting forever, None waits regardless
+			if not self.qFlag:
+				raise RuntimeError('throttle() needs a queue, call queue() first')
+			self.high = high
+			self.low = high // 2 if low is None else low
+			self.reject = reject			# Keep reading but NAK instead of pausing reads
+			self.rejectStatus = status
+			self.rejectError = error
+			self.depth = 0
+			self.checked = 0
+			self.throttledAt = 0
+			self.stall = stall
+			self.stallDepth = 0
+			self.stallSince = 0
+			self.throttleStats = {'throttles':0,'rejected':0,'seconds':0.0}
+			self.throttleFlag = True
+
+		def overloaded(self):
+			"""Checks the waiting messages against the watermarks"""
+			# Recounting the queue table is a query, so between recounts we estimate
+			now = time.monotonic()
+			if now - self.checked >= .1:
+				self.depth = len(self.frames) + self.q.depth(inbound=True)
+				self.checked = now
+			if self.throttled and self.depth <= self.low:
+				self.throttled = False
+				self.throttleStats['seconds'] += now - self.throttledAt
+			elif not self.throttled and self.depth >= self.high:
+				self.throttled = True
+				self.throttledAt = now
+				self.throttleStats['throttles'] += 1
+				self.stallDepth = self.depth
+				self.stallSince = now
+			elif self.throttled:
+				# Making sure something is draining the queue table
+				if self.depth < self.stallDepth:
+					self.stallDepth = self.depth
+					self.stallSince = now
+				elif self.stall is not None and now - self.stallSince >= self.stall:
+					raise RuntimeError(f'Queue depth stuck at {self.depth} for {self.stall} seconds while throttled, '
+						'nothing is marking the queue table processed (see throttle())')
+			return self.throttled
+
+		def throttleMetrics(self):
+			"""Returns times throttled, messages rejected and seconds spent throttled"""
+			stats = dict(self.throttleStats)
+			if self.throttled:
+				stats['seconds'] += time.monotonic() - self.throttledAt
+			stats['depth'] = self.depth
+			return stats
+
 		def start(self):
 			# Initializes and creates socket
 			ib = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-			ib.settimeout(.01)
+			ib.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
 			# Binding to address and port
 			host = ''
 			ib.bind((host,self.port))
+			self.port = ib.getsockname()[1]	# In case port 0 was used
+			self.stats.name = str(self.port)
 
 			# Starts listener
-			ib.listen(0)
+			ib.listen(socket.SOMAXCONN)
+			ib.setblocking(False)
 			self.ib = ib
 			
 			# Connecting to database
@@ -781,113 +959,228 @@ class tcp:
 			#	self.q.connect()
 
 			def startListener():
+				# Serving every connected client from one thread
+				sel = selectors.DefaultSelector()
+				sel.register(ib, selectors.EVENT_READ)
+				self.conns = {}		# Connection -> partial frame bytes
+				frames = self.frames
 				while True:
-					# Connecting to client
 					if self.halt:
 						# They are stopping the connection
 						break
-					addr = False
-					try:
-						conn, addr = ib.accept()
-					except socket.timeout:
-						pass
-					if addr:
-						# This is the remote IP and port
-						self.address = addr
-						self.conn = conn
-					try:
-						data = conn.recv(65536)
-					except:
+					if not frames:
+						# End of a read round, committing before ACKing what was queued
+						if self.unacked:
+							self.release(sel)
+							while self.ready:
+								yield self.ready.popleft()
+						elif self.qFlag and self.q.due():
+							self.q.flush()
+						if self.dedupFlag:
+							self.remembered()
+						if self.throttleFlag and not self.reject and self.overloaded():
+							# Not reading lets the TCP windows close on the senders
+							time.sleep(.05)
+							continue
+						try:
+							events = sel.select(min(.1, self.q.interval) if self.qFlag and self.q.pending else .1)
+						except (OSError, ValueError):
+							continue	# Listener closed by stop()
+						for key, mask in events:
+							sock = key.fileobj
+							if sock is ib:
+								self.accept(sel)
+							else:
+								self.read(sel, sock, frames)
 						continue
-					if data:    
-						if b'\x1c' not in data:
-							# Waiting on the end of the message in case its a long message
-							self.largeMsg.append(data)        # Converting from byte to string
-							continue                            # Keep listening for rest of message
-						if self.largeMsg:
-							self.largeMsg.append(data)      # Add the last section
-							data = b''.join(self.largeMsg)
-							self.largeMsg = []
-
-						# Stripping Vertical Tab and File Separators
-						data = data.replace(b'\x0b', b'') # Vertical Tab
-						data = data.replace(b'\x1c', b'') # File Separator
-						data = data.decode('utf-8','ignore')       # Converting from byte to string, ignoring errors
-						
-						# If queueing is enabled, add to database
-						if self.qFlag:
-							self.pId = self.q.insert(data)
 
-						# ACK or NACK back
+					# Processing one message, setting conn so ack() answers the right client
+					conn, addr, frame, received = frames.popleft()
+					self.conn = conn
+					self.address = addr
+					self.stats.inc('messages')
+					self.stats.inc('bytes', len(frame))
+
+					# Telling the sender to retry later while overloaded, before dedup
+					# remembers the message so the retry isn't taken for a duplicate
+					if self.throttleFlag and self.reject and self.overloaded():
+						self.throttleStats['rejected'] += 1
+						self.stats.inc('rejected')
+						try:
+							ACK = self.ack(frame,self.rejectStatus,self.rejectError,record=False)
+						except OSError:
+							self.stats.inc('errors')
+							self.drop(sel, conn)
+						continue
+
+					# Re-ACKing retransmissions without passing them on
+					if self.dedupFlag and self.duplicate(frame):
+						self.stats.inc('duplicates')
 						if self.ackFlag:
-							ACK = self.ack(data,'AA')
+							try:
+								ACK = self.ack(frame,'AA',record=False)	# The first copy's ACK is already queued
+							except OSError:
+								self.stats.inc('errors')
+								self.drop(sel, conn)	# Client went away after retransmitting
+						continue
 
-						# This should be the received HL7 message
-						yield data
+					data = frame.decode('utf-8','ignore')       # Converting from byte to string, ignoring errors
+					
+					# If queueing is enabled, add to database
+					if self.qFlag:
+						self.pId = self.q.insert(data)
+						if self.throttleFlag:
+							self.depth += 1
+
+					# Holding the ACK and the message until the batch holding it commits,
+					# the consumer only sees the batch once its ACKs are out
+					if self.durable and self.ackFlag:
+						self.unacked.append((conn, frame, self.pId, received))
+						self.ready.append(data)
+						if len(self.unacked) >= self.q.batch or not frames:
+							self.release(sel)
+							while self.ready:
+								yield self.ready.popleft()
+						continue
+
+					# ACK or NACK back, built from the MSH bytes without decoding
+					elif self.ackFlag:
+						try:
+							ACK = self.ack(frame,'AA')
+						except OSError:
+							self.stats.inc('errors')
+							self.drop(sel, conn)	# Client went away before its ACK
+							continue
+						self.stats.observe('receive_to_ack', time.perf_counter() - received)
+
+					# This should be the received HL7 message
+					yield data
+
+				# Closing client connections
+				if self.unacked:
+					self.release(sel)
+				if self.qFlag:
+					self.q.flush()
+				if self.dedupFlag:
+					self.remembered(force=True)
+				for conn in list(self.conns):
+					self.drop(sel, conn)
+				sel.close()
 
 			self.generator = startListener()
 
-		def ack(self,raw,status,error=''):
+		def accept(self,sel):
+			"""Accepts waiting client connections"""
+			while True:
+				try:
+					conn, addr = self.ib.accept()
+				except (BlockingIOError, OSError):
+					return
+				conn.setblocking(True)
+				conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # ACKs go out immediately
+				self.conns[conn] = b''
+				self.stats.inc('connections')
+				sel.register(conn, selectors.EVENT_READ, addr)
+
+		def read(self,sel,conn,frames):
+			"""Reads from a client and splits complete MLLP frames off its buffer"""
+			try:
+				data = conn.recv(65536)
+			except OSError:
+				data = b''
+			if not data:
+				self.drop(sel, conn)
+				return
+			addr = sel.get_key(conn).data
+			received = time.perf_counter()
+			buf = self.conns[conn] + data
+			end = buf.find(b'\x1c')
+			while end != -1:
+				# Stripping Vertical Tab, File Separator and the <CR> that follows it
+				start = buf.find(b'\x0b', 0, end) + 1
+				frames.append((conn, addr, buf[start:end], received))
+				buf = buf[end+1:]
+				end = buf.find(b'\x1c')
+			self.conns[conn] = buf
+
+		def drop(self,sel,conn):
+			"""Closes a client connection"""
+			try:
+				sel.unregister(conn)
+			except (KeyError, ValueError):
+				pass
+			self.conns.pop(conn, None)
+			conn.close()
+
+		def ack(self,raw,status,error='',conn=None,record=True):
 			"""Creates AA,AE or AR ACK message and returns it to sender"""
-			# First we parse the message
-			ACK = ""
-				
-			# Get the field separator from MSH-1
-			fld = raw[3:4]
+			if isinstance(raw, str):
+				raw = raw.encode('utf-8')
+			parts = self.ackParts(raw, status, error)
+
+			# Sending ACK back on same connection, scatter-gather where supported
+			if conn is None:
+				conn = self.conn
+			if hasattr(conn, 'sendmsg'):
+				sent = conn.sendmsg(parts)
+				size = sum(len(part) for part in parts)
+				if sent < size:
+					conn.sendall(b''.join(parts)[sent:])
+			else:
+				conn.sendall(b''.join(parts))
+
+			# Dropping the MLLP wrapper
+			ACK = b''.join(parts[1:-1]).decode('utf-8','ignore')
+
+			# Adding to Queue, unless the message itself was never queued
+			if self.qFlag and record:
+				cId = self.q.insert(ACK, self.pId)
+
+			# Returning ACK to use if they do it directly
+			return ACK
+
+		@classmethod
+		def ackParts(cls,raw,status,error=''):
+			"""Builds the MLLP wrapped ACK fragments from the MSH of the raw message bytes"""
+			# Get the field and component separators from MSH-1 and MSH-2
 			fld = raw[3:4]
 			com = raw[4:5]
+			fields, ret = cls.mshFields(raw)
+
+			# Changing MSH-9-1
+			if len(fields) > 8:
+				coms = fields[8].split(com, 1)
+				coms[0] = b'ACK'
+				fields[8] = com.join(coms)
+			msgId = fields[9] if len(fields) > 9 else b''
 
-			# Finding the newline or return character
-			if "\n" in raw:
-				ret = "\n"
-			else:
-				ret = "\r"
-
-			# Splitting segments
-			segments = raw.split(ret)
-			# Splitting MSH fields
-			fields = segments[0].split(fld)
-			i = 0
-			MSH = ""
-			if len(fields) < 12:
-				l = len(fields)
-			else:
-				l = 12  # We cap at 12
-			while i < l:
-				if i == 8:
-					# Changing MSH-9-1
-					coms = fields[i].split(com)
-					coms[0] = 'ACK'
-					fields[i] = com.join(coms) 
-				MSH += fields[i] + fld
-				i += 1
-			MSH = MSH[0:len(MSH) - 1]# Trimming last field character
-			# Combining MSH segment with MSA segment
 			# MSA|AA or AE or AR|MSH-10 value
+			MSA = b'MSA' + fld + status.encode() + fld + msgId
 			if error != '':
-				ACK = MSH + ret + "MSA" + fld + status + fld + fields[9] + fld + str(error) + ret
-			else:
-				ACK = MSH + ret + "MSA" + fld + status + fld + fields[9] + ret
-				
-			# Wraps message and sends outbound
-			SB = '\x0b'  # <SB>, vertical tab
-			EB = '\x1c'  # <EB>, file separator
-			CR = '\x0d'  # <CR>, \r
-			FF = '\x0c'  # <FF>, new page form feed
-				
-			# wrap in MLLP message container
-			data = SB + ACK + EB + CR
-			data = bytes(data, "utf-8")
+				MSA += fld + str(error).encode('utf-8')
 
-			# Sending ACK back on same connection
-			self.conn.send(data)
+			return [cls.SB, fld.join(fields), ret, MSA, ret, cls.EB]
 
-			# Adding to Queue
-			if self.qFlag:
-				cId = self.q.insert(ACK, self.pId)
+		@staticmethod
+		def mshFields(raw):
+			"""Returns the first 12 MSH fields of the raw message bytes and its line ending"""
+			fld = raw[3:4]
 
-			# Returning ACK to use if they do it directly
-			return ACK
+			# Only slicing out the MSH segment, the rest of the message is never touched
+			cr = raw.find(b'\r')
+			lf = raw.find(b'\n')
+			if cr == -1 and lf == -1:
+				end = len(raw)
+				ret = b'\r'
+			elif lf == -1 or (cr != -1 and cr < lf):
+				end = cr
+				ret = b'\r'
+			else:
+				end = lf
+				ret = b'\n'
+
+			# Splitting MSH fields, we cap at 12
+			return raw[:end].split(fld, 12)[:12], ret
 
 		def stop(self):
 			# Stops the listener
@@ -930,6 +1223,8 @@ class tcp:
 			self.host = host
 			self.port = port
 			self.qFlag = False
+			self.policy = tcp.retry()	# Backoff and circuit breaker used by send
+			self.stats = metrics('tcp_client', f'{host}:{port}')
 			#self.dbId = self.queue()
 			
 			# Initializes and creates socket
@@ -965,6 +1260,7 @@ class tcp:
 				return False
 
 		def restart(self):
+			self.stats.inc('reconnects')
 			try:
 				self.cnxn.close()
 			except:
@@ -993,17 +1289,39 @@ class tcp:
 			return status
 		
 		def send(self,message):
-			if self.ackFlag:
-				ack = False	
-				while not ack:
-					if not self.status:
-						self.restart()
-					ack = self.sender(message)
-				return ack
-			else:
+			if not self.ackFlag:
 				ret = self.sender(message)
 				return ret
 
+			# Retrying until ACK'd, backing off while the remote host is down
+			policy = self.policy
+			attempt = 0
+			while True:
+				wait = policy.wait()
+				while wait:
+					if policy.attempts:
+						return False	# Bounded retries fail fast while the circuit is open
+					# Circuit is open, asking again after the cooldown so the next attempt is the probe
+					time.sleep(wait)
+					wait = policy.wait()
+				if attempt:
+					policy.stats['retries'] += 1	# Counted once the retry is actually made
+				if not self.status:
+					self.restart()
+				ack = False
+				if self.status:
+					ack = self.sender(message)
+				attempt += 1
+				policy.stats['attempts'] += 1
+				if ack and (not policy.nak or self.evaluate(ack)):
+					policy.success()
+					return ack
+				policy.failure('nak' if ack else 'timeout')
+				if policy.attempts and attempt >= policy.attempts:
+					return ack	# Last NAK received or False
+				if policy.state != 'OPEN':
+					time.sleep(policy.delay(attempt))
+
 		def sender(self,message):
 			"""Sends data to outbound TCP connection"""
 			# Wraps message and sends outbound
@@ -1017,11 +1335,15 @@ class tcp:
 			msg = bytes(MLLP, "utf-8")
 			
 			# Sending message
+			sent = time.perf_counter()
 			try:
 				self.cnxn.send(msg)
 			except Exception as e:
 				self.status = False
+				self.stats.inc('errors')
 				return False
+			self.stats.inc('messages')
+			self.stats.inc('bytes', len(msg))
 				
 			# Adding to Queue
 			if self.qFlag:
@@ -1034,7 +1356,9 @@ class tcp:
 					ACK = self.cnxn.recv(RECV_BUFFER)   
 				except Exception as e:
 					self.status = False
+					self.stats.inc('errors')
 					return False
+				self.stats.observe('send_to_ack', time.perf_counter() - sent)
 				ACK = ACK.replace(b"\x0b", b"") # Vertical Tab
 				ACK = ACK.replace(b"\x1c", b"") # File Separator
 				ACK = ACK.decode()
@@ -1076,12 +1400,245 @@ class tcp:
 			self.timeout = timeout
 			self.cnxn.settimeout(self.timeout)
 
+		def setRetry(self,policy):
+			"""Sets the tcp.retry policy used when sending"""
+			self.policy = policy
+
+	class retry():
+		"""Retry policy with exponential backoff and a circuit breaker"""
+		def __init__(self,attempts=None,backoff=.5,maxBackoff=30,jitter=True,threshold=5,cooldown=30,nak=False):
+			self.attempts = attempts		# None retries until ACK'd
+			self.backoff = backoff			# Seconds before the first retry, doubled every retry
+			self.maxBackoff = maxBackoff	# Cap on the backoff
+			self.jitter = jitter			# Randomizing backoff so senders don't retry in step
+			self.threshold = threshold		# Consecutive failures before the circuit opens
+			self.cooldown = cooldown		# Seconds open before a half-open probe is allowed
+			self.nak = nak					# Also retry when evaluate() finds an AE/AR ACK
+			self.state = 'CLOSED'
+			self.failures = 0
+			self.opened = 0
+			self.stats = {'attempts':0,'retries':0,'timeouts':0,'naks':0,'opens':0,'openTime':0.0}
+
+		def delay(self,attempt):
+			"""Seconds to wait before retrying after the given attempt"""
+			wait = min(self.maxBackoff, self.backoff * 2 ** (attempt - 1))
+			if self.jitter:
+				wait = random.uniform(0, wait)
+			return wait
+
+		def wait(self):
+			"""Seconds until the circuit allows another attempt"""
+			if self.state == 'OPEN':
+				remaining = self.opened + self.cooldown - time.monotonic()
+				if remaining > 0:
+					return remaining
+				self.state = 'HALF-OPEN'	# Next attempt is the probe
+			return 0
+
+		def success(self):
+			"""Records an ACK'd attempt and closes the circuit"""
+			if self.state != 'CLOSED':
+				self.stats['openTime'] += time.monotonic() - self.opened
+				self.state = 'CLOSED'
+			self.failures = 0
+
+		def failure(self,kind='timeout'):
+			"""Records a failed attempt, opening the circuit if the host looks down"""
+			if kind == 'nak':
+				# Remote host is up, it just didn't accept the message
+				self.stats['naks'] += 1
+				return
+			self.stats['timeouts'] += 1
+			self.failures += 1
+			if self.state == 'HALF-OPEN':
+				# Probe failed, staying open for another cooldown
+				self.stats['openTime'] += time.monotonic() - self.opened
+				self.state = 'OPEN'
+				self.opened = time.monotonic()
+			elif self.state == 'CLOSED' and self.failures >= self.threshold:
+				self.state = 'OPEN'
+				self.opened = time.monotonic()
+				self.stats['opens'] += 1
+
+		def metrics(self):
+			"""Returns retry counts and seconds spent with the circuit open"""
+			stats = dict(self.stats)
+			if self.state != 'CLOSED':
+				stats['openTime'] += time.monotonic() - self.opened
+			stats['state'] = self.state
+			return stats
+
+	class asyncClient():
+		"""Class connects to remote client and sends data using asyncio"""
+		def __init__(self,host,port):
+			# Initializes connection object, socket is opened on start/send
+			self.ackFlag = True
+			self.status = False
+			self.timeout = 5
+			self.host = host
+			self.port = port
+			self.qFlag = False
+			self.reader = None
+			self.writer = None
+			self.dropped = False		# Last send found the connection closed by the remote host
+			self.lock = asyncio.Lock()	# One message in flight per connection
+			self.stats = metrics('tcp_async_client', f'{host}:{port}')
+
+		def queue(self, name='', db=''):
+			# Creates a database queue for the connection
+			self.q = database(name, db)
+			self.pId = None
+			self.qFlag = True
+
+		def evaluate(self,ack):
+			"""Parsing the ACK and evaluating MSA-1"""
+			f = ack[3:4]
+			if 'MSA'+f+'AA' not in ack:
+				return False
+			else:
+				return True
+
+		async def start(self):
+			"""Connects to remote host"""
+			try:
+				connect = asyncio.open_connection(self.host, self.port)
+				self.reader, self.writer = await asyncio.wait_for(connect, self.timeout)
+				self.status = True
+				return True
+			except (OSError, asyncio.TimeoutError):
+				self.status = False
+				return False
+
+		async def restart(self):
+			await self.stop()
+			return await self.start()
+
+		async def stop(self):
+			"""Stops the connection"""
+			self.status = False
+			if not self.writer:
+				return True
+			try:
+				self.writer.close()
+				await self.writer.wait_closed()
+				status = True
+			except Exception:
+				status = False
+			self.reader = None
+			self.writer = None
+			return status
+
+		async def send(self,message):
+			"""Sends message, connecting lazily, and returns the ACK"""
+			async with self.lock:
+				# A connection that was open may have been dropped by the remote
+				# host while idle, so we retry once on a fresh connection. A slow
+				# ACK is not retried, the remote host may already have the message
+				stale = self.status
+				if not self.status and not await self.start():
+					return False
+				ret = await self.sender(message)
+				if ret is False and stale and self.dropped:
+					self.stats.inc('reconnects')
+					if await self.restart():
+						ret = await self.sender(message)
+				return ret
+
+		async def sender(self,message):
+			"""Sends data to outbound TCP connection"""
+			# Wrap in MLLP message container and converts to bytes
+			SB = '\x0b'  # <SB>, vertical tab
+			EB = '\x1c'  # <EB>, file separator
+			CR = '\x0d'  # <CR>, \r
+			msg = bytes(SB + message + EB + CR, "utf-8")
+
+			# Sending message
+			sent = time.perf_counter()
+			self.dropped = False
+			try:
+				self.writer.write(msg)
+				await self.writer.drain()
+			except Exception:
+				self.stats.inc('errors')
+				self.dropped = True
+				await self.stop()
+				return False
+			self.stats.inc('messages')
+			self.stats.inc('bytes', len(msg))
+
+			# Adding to Queue
+			if self.qFlag:
+				self.pId = self.q.insert(message, self.pId)
+
+			if not self.ackFlag:
+				return True
+
+			# Reading up to the end block of the ACK
+			try:
+				ACK = await asyncio.wait_for(self.reader.readuntil(b'\x1c'), self.timeout)
+			except Exception as e:
+				# Closed before the ACK, as opposed to a timeout waiting on it
+				self.dropped = isinstance(e, (asyncio.IncompleteReadError, ConnectionError))
+				self.stats.inc('errors')
+				await self.stop()
+				return False
+			self.stats.observe('send_to_ack', time.perf_counter() - sent)
+			ACK = ACK.replace(b"\x0b", b"") # Vertical Tab
+			ACK = ACK.replace(b"\x1c", b"") # File Separator
+			ACK = ACK.decode().lstrip('\r\n') # Trailing <CR> of previous frame
+
+			# Adding to Queue
+			if self.qFlag:
+				cId = self.q.insert(ACK, self.pId)
+				self.pId = None
+
+			# Returning ACK string
+			return ACK
+
+		def expectAck(self,boolian):
+			"""Setings true or false on whether to expect ACK's.  Default in True"""
+			if not boolian:
+				self.ackFlag = False
+			else:
+				self.ackFlag = True
+
+		def setTimeout(self,timeout):
+			"""Setings time timeout on connecting and waiting ACK's.  Default is 5 seconds"""
+			self.timeout = timeout
+
+	class pool():
+		"""Keeps persistent asyncio connections to many remote hosts"""
+		def __init__(self,timeout=5):
+			self.timeout = timeout
+			self.clients = {}	# (host, port) -> asyncClient
+
+		def client(self,dest):
+			"""Returns the connection for a (host, port) destination, creating it if needed"""
+			dest = tuple(dest)
+			if dest not in self.clients:
+				host, port = dest
+				cnxn = tcp.asyncClient(host, port)
+				cnxn.setTimeout(self.timeout)
+				self.clients[dest] = cnxn
+			return self.clients[dest]
+
+		async def send(self,dest,message):
+			"""Sends message to a (host, port) destination and returns the ACK"""
+			return await self.client(dest).send(message)
+
+		async def close(self):
+			"""Closes all connections in the pool"""
+			for cnxn in self.clients.values():
+				await cnxn.stop()
+			self.clients = {}
+
 #---------------------------------------#
 #  Class for file Reading and Writing   #
 #---------------------------------------#
 class file:
 	"""File reader designed for reading HL7 files"""
 	msgList = []
+	batchSegments = ('FHS', 'BHS', 'BTS', 'FTS')
 
 	def __init__(self,path=None,fn=None):
 		if not path:
@@ -1090,6 +1647,16 @@ class file:
 		self.path = path
 		self.qFlag = False
 		
+		# Writer is opened once and kept open, see buffered()
+		self.f = None
+		self.bufferSize = -1		# Default io buffer
+		self.flushEvery = 1			# Flush after this many messages, None to not count
+		self.flushInterval = None	# Flush when this many seconds passed since the last
+		self.fsyncFlag = False		# Also fsync to disk on every flush
+		self.flushSet = False		# Policy came from buffered() rather than the defaults
+		self.pending = 0
+		self.flushed = time.monotonic()
+		
 		self.fn = fn
 		if self.fn:
 			# If they supply a fn we get the full path
@@ -1101,6 +1668,7 @@ class file:
 		if '*' in self.fullpath:
 			# They used a wildcard so use glob to find filname
 			self.fullpath = glob(self.fullpath)[0]
+		self.stats = metrics('file', self.fullpath)
 			
 	def filename(self, fn=''):
 		# Used if they wan to dynamically create a fn
@@ -1121,7 +1689,7 @@ class file:
 
 	def read(self,splitChar = False):
 		# Reads file and splits HL7 messages
-		with open(self.fullpath,encoding='utf8',errors='ignore') as f:
+		with self.openText('r',encoding='utf8',errors='ignore') as f:
 			data = f.read()
 		f.close()
 		file.msgList = []
@@ -1134,10 +1702,12 @@ class file:
 			if msg == '':
 				continue
 			file.msgList.append(splitChar + msg)
+			self.stats.inc('messages')
+			self.stats.inc('bytes', len(splitChar) + len(msg))
 		
-			# If queueing is enabled, add to database
-			if self.qFlag:
-				self.pId = self.q.insert(splitChar + msg)
+		# If queueing is enabled, add to database in one go
+		if self.qFlag and file.msgList:
+			self.pId = self.q.insert_many(file.msgList)[-1]
 
 		return file.msgList
 		
@@ -1145,10 +1715,10 @@ class file:
 		# Reading in large files and getting messages in generator
 		
 		def yieldMsg(splitChar):
-			# Initializing variables
-			raw = ''
+			# Initializing variables, lines are joined once the message is complete
+			raw = []
 			reading = False
-			with open(self.fullpath, 'r',encoding='utf-8') as f:
+			with self.openText('r',encoding='utf-8') as f:
 				for ln, line in enumerate(f, start=1):
 					if not splitChar:
 						# Use regex pattern to capture split characters from standard HL7 format
@@ -1159,30 +1729,110 @@ class file:
 					if line[0:8] == splitChar:
 						if not reading:
 							reading = True # Start reading message
-							raw = ''
+							raw = []
 						else:
 							reading = False # Stop reading message
 					
 					if reading:
 						# Building HL7 message
-						raw += line
+						raw.append(line)
 						continue
 					else:
 						# Process HL7
-						msg = raw 		# This is the completed message we return
-						raw = line		# Starting new message
-						reading = True	# Setting this variable
+						msg = ''.join(raw)	# This is the completed message we return
+						raw = [line]		# Starting new message
+						reading = True		# Setting this variable
 						
 						# If queueing is enabled, add to database
 						if self.qFlag:
 							self.pId = self.q.insert(msg)
 						
+						self.stats.inc('messages')
+						self.stats.inc('bytes', len(msg))
 						yield msg		# Returning completed message
 				
 				return False
 						
 		self.generator = yieldMsg(splitChar)
 		
+	def follow(self,interval=.5,idle=None,name='',db=''):
+		"""Follows a growing file like tail -F, yielding complete messages and checkpointing its offset"""
+		# Offsets are kept in SQLite so a restart resumes after the last processed message
+		self.offsets = database(name, db) if name else None
+		
+		def followMsg():
+			key = path.abspath(self.fullpath)
+			offset, ident = self.offsets.position(key) if self.offsets else (0, None)
+			f = None
+			split = None
+			grew = time.monotonic()
+			while True:
+				if f is None:
+					# Opening the file, waiting if it has been rotated away
+					try:
+						f = open(self.fullpath, 'rb')
+					except FileNotFoundError:
+						time.sleep(interval)
+						continue
+					st = fstat(f.fileno())
+					current = f'{st.st_dev}:{st.st_ino}'
+					if current != ident or st.st_size < offset:
+						offset = 0	# Different file or truncated since the checkpoint
+					ident = current
+					f.seek(offset)
+					split = splitter(offset)
+				
+				data = f.read(1024*1024)
+				if data:
+					grew = time.monotonic()
+					for msg, end in split.feed(data):
+						yield from self.followed(msg, key, end, ident)
+					continue
+				
+				# At the end of the file, checking for rotation or truncation
+				try:
+					st = stat(self.fullpath)
+				except FileNotFoundError:
+					st = None
+				if st is None or f'{st.st_dev}:{st.st_ino}' != ident:
+					# Rotated, the last message of the old file is complete
+					last = split.flush()
+					if last:
+						yield from self.followed(last[0], key, last[1], ident)
+					if st is None:
+						time.sleep(interval)
+						continue
+					f.close()
+					f = None
+					offset = 0
+					continue
+				if st.st_size < f.tell():
+					# Truncated in place, starting over
+					f.close()
+					f = None
+					offset = 0
+					ident = None
+					continue
+				if idle and split.start is not None and time.monotonic() - grew >= idle and split.buf[-1:] in (b'\r', b'\n'):
+					# Nothing appended for a while, treating the open message as complete
+					last = split.flush()
+					yield from self.followed(last[0], key, last[1], ident)
+					continue
+				time.sleep(interval)
+		
+		self.generator = followMsg()
+
+	def followed(self,msg,key,end,ident):
+		# Yields a followed message, then checkpoints once the consumer asks for the next
+		msg = msg.decode('utf-8','ignore')
+		if self.qFlag:
+			self.pId = self.q.insert(msg)
+		self.stats.inc('messages')
+		self.stats.inc('bytes', len(msg))
+		yield msg
+		if self.offsets:
+			self.offsets.checkpoint(key, end, ident)
+
 	def getMsg(self):
 		# Getting message from fileReader
 		try:
@@ -1190,37 +1840,143 @@ class file:
 		except StopIteration:
 			return None
 		
+	# Compressed formats by extension and by magic bytes
+	codecs = {'.gz':gzip, '.bz2':bz2, '.xz':lzma, '.lzma':lzma}
+	magic = ((b'\x1f\x8b', gzip), (b'BZh', bz2), (b'\xfd7zXZ\x00', lzma))
+
+	def compression(self):
+		"""Returns the gzip, bz2 or lzma module for a compressed file, otherwise None"""
+		name = self.fullpath
+		if name.endswith('.tmp'):
+			name = name[:-4]	# Temp names used while writing
+		ext = path.splitext(name)[1].lower()
+		if ext in file.codecs:
+			return file.codecs[ext]
+		try:
+			with open(self.fullpath, 'rb') as f:
+				head = f.read(6)
+		except OSError:
+			return None
+		for sig, codec in file.magic:
+			if head.startswith(sig):
+				return codec
+		return None
+
+	def openText(self,mode='r',buffering=-1,**kwargs):
+		"""Opens the file in text mode, streaming through the codec if it is compressed"""
+		codec = self.compression()
+		if codec is None:
+			return open(self.fullpath, mode, buffering=buffering, **kwargs)
+		return codec.open(self.fullpath, mode + 't', **kwargs)
+
+	def openBytes(self,mode='rb'):
+		"""Opens the file in binary mode, streaming through the codec if it is compressed"""
+		codec = self.compression()
+		if codec is None:
+			return open(self.fullpath, mode)
+		return codec.open(self.fullpath, mode)
+
+	def messages(self):
+		"""Streams every message in the file, plain or compressed, skipping batch segments"""
+		split = splitter()
+		with self.openBytes() as f:
+			while True:
+				block = f.read(1024*1024)
+				if not block:
+					break
+				for msg, end in split.feed(block):
+					yield msg.decode('utf-8','ignore')
+		last = split.flush()
+		if last:
+			yield last[0].decode('utf-8','ignore')
+
 	def open(self,flag='a'):
 		try:
+			if self.f is not None:
+				self.close()
 			if flag.lower() == 'w':
-				self.f = open(self.fullpath,'w')
+				self.f = self.openText('w',buffering=self.bufferSize)
 			else:
-				self.f = open(self.fullpath,'a')
+				self.f = self.openText('a',buffering=self.bufferSize)
+			if not self.flushSet:
+				# Each flush of a compressed stream writes a sync block, so by default
+				# they are left to the codec and close() rather than done per message
+				self.flushEvery = None if self.compression() else 1
+			self.pending = 0
+			self.flushed = time.monotonic()
 			return self
 		except:
 			return "Unable to write to file %s" % (self.fullpath)
 
+	def buffered(self,size=1024*1024,every=None,interval=1,fsync=False):
+		"""Sets the write buffer size and when writes are flushed (every N messages, every interval seconds)"""
+		# The interval is checked on write() and check(), call check() when idle and close() at the end
+		self.bufferSize = size
+		self.flushEvery = every
+		self.flushInterval = interval
+		self.fsyncFlag = fsync
+		self.flushSet = True
+		if self.f is not None:
+			self.open()	# Reopening with the new buffer size
+		return self
+
 	def write(self,data):
 		"""Writing or appending to file"""
-		self.open()
+		if self.f is None:
+			self.open()
 		try:
 			self.f.write(data)
+			self.stats.inc('messages')
+			self.stats.inc('bytes', len(data))
 			
 			# If queueing is enabled, add to database
 			if self.qFlag:
 				self.pId = self.q.insert(data)
-				
-			if not file.appendFlag:
-				self.f.close()
+			
+			# Flushing per the policy, by default after every message
+			self.pending += 1
+			if self.flushEvery and self.pending >= self.flushEvery:
+				self.flush()
+			elif self.flushInterval is not None and time.monotonic() - self.flushed >= self.flushInterval:
+				self.flush()
 			
 			return self
 		except:
+			self.stats.inc('errors')
 			return False
 	send = write # In case they want to keep it consistent with TCP class
 
+	def check(self):
+		"""Flushes if the interval has passed since the last flush, for calling on idle intervals"""
+		if self.f is None or not self.pending or self.flushInterval is None:
+			return False
+		if time.monotonic() - self.flushed >= self.flushInterval:
+			return self.flush()
+		return False
+
+	def flush(self):
+		"""Flushing buffered writes, and syncing to disk if set"""
+		if self.f is None:
+			return False
+		self.f.flush()
+		if self.fsyncFlag:
+			fsync(self.f.fileno())
+		self.pending = 0
+		self.flushed = time.monotonic()
+		return True
+
 	def close(self):
 		"""Closing file"""
-		self.fullpath.close()
+		if self.f is not None:
+			self.flush()
+			self.f.close()
+			self.f = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
 
 	def delete(self):
 		"""Deleting file after finished"""
@@ -1237,91 +1993,595 @@ class file:
 			self.fullpath = newname
 
 	def batch(self,fn='',comments = ''):
-		"""HL7 batching file"""
-		# Reading file
+		"""HL7 batching file, reading and writing it once"""
 		if not self.fn:
 			self.fn = self.fullpath
-		temp = open(self.fullpath,'r')
-		# If FHS or BHS segments already exist, remove them
-		data = temp.read()
-		temp.close()
-		temp = open(self.fullpath,'w')
-		data = data.replace('\n','\r')
-		data = re.sub(r'FHS(.*?)\r|BHS(.*?)\r','',data)
-		temp.write(data)
-		temp.close()
-		messages = self.read()
-		# Getting MSH segment from first message
-		MSH = messages[0]
-		MSH = MSH.replace('\n','\r')
-		MSH = MSH.split('\r')
-		MSH = MSH[0]
-		fld = MSH[3:4]
-		total = self.total()
-
-		# Editing FHS segment
-		FHSList = MSH.split(fld)
-		FHSList[0] = 'FHS'
-		FHSList[6] = datetime.strftime(datetime.now(),'%Y%m%d%H%M%S')
-		FHSList[8] = self.fn
-		FHSList[9] = comments
-		FHSList[10] = datetime.strftime(datetime.now(),'%Y%m%d%H%M%S')
-		i = 0
-		FHS = ''
-		while i < 11:
-			# We only want first 11 fields
-			if i == 10:
-				FHS += FHSList[i]
-			else:
-				FHS += FHSList[i] + fld
-			i += 1
+		target = fn if fn != '' else self.fullpath	# They may want to write to a new fn
+		segments = self.segments()
 
-		# Editing BHS segment
-		BHSList = MSH.split(fld)
-		BHSList[0] = 'BHS'
-		BHSList[6] = datetime.strftime(datetime.now(),'%Y%m%d%H%M%S')
-		BHSList[8] = ''
-		BHSList[9] = comments
-		BHSList[10] = datetime.strftime(datetime.now(),'%Y%m%d%H%M%S')
-		i = 0
-		BHS = ''
-		while i < 11:
-			# We only want first 11 fields
-			if i == 10:
-				BHS += BHSList[i]
-			else:
-				BHS += BHSList[i] + fld
-			i += 1
-		
-		# Writing FHS and BHS segments to file with original data
-		batch = open(self.fullpath,'r')
-		data = batch.read()
-		batch.close()
-		if fn != '':
-			batch = open(fn,'w')    # They want to write to a new fn
-		else:
-			batch = open(self.fullpath,'w')
-		data = data.replace('\n','\r')
-		batch.write(FHS+'\r'+BHS+'\r'+data+'BHS'+fld+str(total)+'\r'+'FHS'+fld+'1'+'\r')
-		batch.close()
+		# Holding segments up to the first MSH, its header builds the FHS and BHS
+		head = []
+		MSH = ''
+		for seg in segments:
+			if seg[0:3] in file.batchSegments:
+				continue	# If FHS or BHS segments already exist, remove them
+			head.append(seg)
+			if seg[0:3] == 'MSH':
+				MSH = seg
+				break
+		if not MSH:
+			return False
+		fld = MSH[3:4]
+		FHS, BHS = self.batchHeaders(MSH, self.fn, comments)
+
+		# Streaming to a temp file, counting messages for the BTS as we go
+		out = file(target + '.tmp')
+		total = 0
+		with out.openText('w',encoding='utf-8') as f:
+			f.write(FHS + '\r' + BHS + '\r')
+			for seg in chain(head, segments):
+				if seg[0:3] in file.batchSegments:
+					continue
+				if seg[0:3] == 'MSH':
+					total += 1
+				f.write(seg + '\r')
+			BTS, FTS = self.batchTrailers(fld, total)
+			f.write(BTS + '\r' + FTS + '\r')
+		replace(out.fullpath, target)
+		return total
+
+	def segments(self):
+		"""Streams the segments of the file without their line endings"""
+		with self.openText('r',encoding='utf-8',errors='ignore') as f:
+			for line in f:
+				line = line.rstrip('\r\n')
+				if line:
+					yield line
+
+	@staticmethod
+	def batchHeaders(MSH, fn='', comments=''):
+		"""Builds FHS and BHS segments from the MSH segment of the first message"""
+		fld = MSH[3:4]
+		stamp = datetime.strftime(datetime.now(),'%Y%m%d%H%M%S')
+		headers = []
+		for seg, name in (('FHS', fn), ('BHS', '')):
+			fields = MSH.split(fld)
+			fields += [''] * (11 - len(fields))
+			fields[0] = seg
+			fields[6] = stamp		# Date/time
+			fields[8] = name		# File name
+			fields[9] = comments	# Comment
+			fields[10] = stamp		# Control ID
+			headers.append(fld.join(fields[:11])) # We only want first 11 fields
+		return headers[0], headers[1]
+
+	@staticmethod
+	def batchTrailers(fld, count, batches=1):
+		"""Builds BTS and FTS segments with the message and batch counts"""
+		return f'BTS{fld}{count}', f'FTS{fld}{batches}'
 
 	def debatch(self):
-		"""HL7 batching file"""
-		# Reading file
-		temp = open(self.fullpath,'r')
-		# If FHS or BHS segments already exist, remove them
-		data = temp.read()
-		temp.close()
-		temp = open(self.fullpath,'w')
-		data = data.replace('\n','\r')
-		data = re.sub(r'FHS(.*?)\r|BHS(.*?)\r','',data)
-		temp.write(data)
-		temp.close()
+		"""HL7 debatching file, removing FHS/BHS/BTS/FTS segments in one pass"""
+		out = file(self.fullpath + '.tmp')
+		with out.openText('w',encoding='utf-8') as f:
+			for seg in self.segments():
+				if seg[0:3] not in file.batchSegments:
+					f.write(seg + '\r')
+		replace(out.fullpath, self.fullpath)
+
+	def split(self,directory=None):
+		"""Splits a batch file into one batch file per BHS, returning their paths"""
+		if not directory:
+			directory = path.dirname(self.fullpath) or '.'
+		stem, dot, ext = path.basename(self.fullpath).partition('.')
+		files = []
+		FHS = ''
+		out = None
+		f = None
+		fld = '|'
+		total = 0
+
+		def finish():
+			# Trailing the batch with recounted BTS and FTS
+			BTS, FTS = self.batchTrailers(fld, total)
+			f.write(BTS + '\r' + FTS + '\r')
+			f.close()
+			replace(out.fullpath, files[-1])
+
+		for seg in self.segments():
+			name = seg[0:3]
+			if name == 'FHS':
+				FHS = seg	# Copied to the top of every output
+				continue
+			if name in ('BTS', 'FTS'):
+				continue
+			if name == 'BHS' or f is None:
+				# Starting the next output file
+				if f is not None:
+					finish()
+				files.append(f'{directory}/{stem}_{len(files)+1}{dot}{ext}')
+				out = file(files[-1] + '.tmp')
+				f = out.openText('w',encoding='utf-8')
+				total = 0
+				fld = seg[3:4]
+				if FHS:
+					f.write(FHS + '\r')
+			if name == 'MSH':
+				total += 1
+			f.write(seg + '\r')
+		if f is not None:
+			finish()
+		return files
 
 	def total(self):
 		"""Return total of inbound messages"""
 		return len(file.msgList)
 
+	def chunks(self, size=64*1024*1024):
+		"""Splits the file into byte ranges of about size that each start on an MSH segment"""
+		total = path.getsize(self.fullpath)
+		cuts = [0]
+		with open(self.fullpath, 'rb') as f:
+			pos = size
+			while pos < total:
+				# Reading forward from the estimate to the next message start
+				base = pos - 1
+				f.seek(base)
+				data = b''
+				cut = total
+				while True:
+					block = f.read(1024*1024)
+					if not block:
+						break
+					data += block
+					m = mapped.start.search(data)
+					if m:
+						cut = base + m.start() + 1
+						break
+					base += len(data) - 4	# Keeping a few bytes in case MSH straddles blocks
+					data = data[-4:]
+				if cut >= total:
+					break
+				cuts.append(cut)
+				pos = cut + size
+		cuts.append(total)
+		return [(cuts[i], cuts[i+1]) for i in range(len(cuts) - 1) if cuts[i] < cuts[i+1]]
+
+	def process(self, callback, workers=None, ordered=True, size=64*1024*1024, parsed=True):
+		"""Runs callback over every message in a process pool, yielding its results"""
+		# The callback is sent to the workers so it has to be a module level function
+		ranges = self.chunks(size)
+		with ProcessPoolExecutor(workers) as pool:
+			futures = [pool.submit(file.work, self.fullpath, start, end, callback, parsed) for start, end in ranges]
+			if not ordered:
+				futures = as_completed(futures)	# Results of whichever range finishes first
+			for future in futures:
+				for result in future.result():
+					yield result
+
+	@staticmethod
+	def work(fullpath, start, end, callback, parsed=True):
+		"""Process pool worker running callback over the messages in one byte range"""
+		reader = mapped(fullpath, persist=False).region(start, end)
+		results = []
+		for msg in reader:
+			results.append(callback(parse(msg) if parsed else msg))
+		reader.close()
+		return results
+
+#---------------------------------------#
+#  Class for writing output files that  #
+#  roll over on count, size or time     #
+#---------------------------------------#
+class rotating(file):
+	"""File writer that rolls over to a new file on message count, size or time"""
+	def __init__(self,path=None,pattern='%Y%m%d%H%M%S_{n}.hl7',count=None,size=None,interval=None,batch=False,comments=''):
+		super().__init__(path)
+		self.directory = self.path
+		self.pattern = pattern		# strftime pattern, {n} is a sequence number
+		self.maxCount = count		# Messages per file
+		self.maxSize = size			# Bytes per file
+		self.interval = interval	# Seconds per file
+		self.batchFlag = batch		# Wrap each file in FHS/BHS and BTS/FTS
+		self.comments = comments
+		self.seq = 0
+		self.files = []				# Completed files
+		self.final = None
+		self.count = 0
+		self.size = 0
+		self.opened = 0
+		self.fld = '|'
+
+	def due(self):
+		"""Checks if the current file should be rolled"""
+		if self.f is None:
+			return False
+		if self.maxCount and self.count >= self.maxCount:
+			return True
+		if self.maxSize and self.size >= self.maxSize:
+			return True
+		if self.interval and time.monotonic() - self.opened >= self.interval:
+			return True
+		return False
+
+	def begin(self,data):
+		"""Opens the next file under a temp name, writing batch headers if set"""
+		self.seq += 1
+		name = datetime.strftime(datetime.now(), self.pattern).format(n=self.seq)
+		self.path = self.directory
+		self.final = self.directory + '/' + name
+		self.filename(name + '.tmp')	# Downstream jobs don't see it until it's renamed
+		self.open('w')
+		self.count = 0
+		self.size = 0
+		self.opened = time.monotonic()
+		if self.batchFlag:
+			MSH = data.replace('\n','\r').split('\r')[0]
+			self.fld = MSH[3:4]
+			FHS, BHS = self.batchHeaders(MSH, name, self.comments)
+			self.f.write(FHS + '\r' + BHS + '\r')
+
+	def write(self,data):
+		"""Writing to the current file, rolling over first if it is due"""
+		if self.due():
+			self.roll()
+		if self.f is None:
+			self.begin(data)
+		ret = super().write(data)
+		self.count += 1
+		self.size += len(data)
+		return ret
+	send = write
+
+	def check(self):
+		"""Rolls the current file if it is due, otherwise flushes on the interval, for calling on idle intervals"""
+		if self.due():
+			return self.roll()
+		file.check(self)
+		return None
+
+	def roll(self):
+		"""Closes the current file and atomically renames it to its final name"""
+		if self.f is None:
+			return None
+		if self.batchFlag:
+			BTS, FTS = self.batchTrailers(self.fld, self.count)
+			self.f.write(BTS + '\r' + FTS + '\r')
+		file.close(self)
+		replace(self.fullpath, self.final)
+		self.files.append(self.final)
+		self.fullpath = self.final
+		return self.final
+
+	def close(self):
+		"""Rolling the last file"""
+		self.roll()
+
+#---------------------------------------#
+#  Class for indexed reading of large   #
+#  HL7 files through a memory map       #
+#---------------------------------------#
+class mapped(file):
+	"""Memory-mapped HL7 file reader with random access by message number"""
+	# Start of a message, or of a batch segment ending one, following a line ending
+	boundary = re.compile(rb'[\r\n](MSH|FHS|BHS|BTS|FTS)(?=[^A-Za-z0-9\r\n])')
+	head = re.compile(rb'(MSH|FHS|BHS|BTS|FTS)(?=[^A-Za-z0-9\r\n])')
+	start = re.compile(rb'[\r\n]MSH(?=[^A-Za-z0-9\r\n])')
+	magic = 0x48373149445801	# Sidecar index header, followed by file size and mtime
+
+	def __init__(self,path=None,fn=None,persist=False):
+		super().__init__(path, fn)
+		# Saving the index to a sidecar, True puts it next to the file as <file>.idx, or give a path.
+		# Off by default so indexing files in drop or archive directories leaves nothing behind
+		self.persist = bool(persist)
+		self.idxpath = persist if isinstance(persist, str) else self.fullpath + '.idx'
+		self.index = None			# Start and end offset pairs for every message
+		self.mm = None
+		self.fh = None
+
+	def load(self):
+		"""Maps the file and loads or builds its message index"""
+		if self.index is not None:
+			return self
+		if self.compression():
+			raise ValueError(f'{self.fullpath} is compressed and can\'t be memory mapped, use file.reader()')
+		self.fh = open(self.fullpath, 'rb')
+		if path.getsize(self.fullpath):
+			self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+		self.index = self.loadIndex()
+		if self.index is None:
+			self.index = self.scan()
+			if self.persist:
+				self.saveIndex()
+		return self
+
+	def region(self, start, end):
+		"""Maps the file and indexes only the messages starting in a byte range"""
+		if self.compression():
+			raise ValueError(f'{self.fullpath} is compressed and can\'t be memory mapped, use file.reader()')
+		self.fh = open(self.fullpath, 'rb')
+		if path.getsize(self.fullpath):
+			self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+		self.index = self.scan(start, end)
+		return self
+
+	def scan(self, start=0, end=None):
+		"""Scans once for message boundaries, returning start and end offset pairs"""
+		index = array('Q')
+		if self.mm is None:
+			return index
+		if end is None:
+			end = len(self.mm)
+		opened = False
+		if start == 0:
+			# No line ending before the first segment of the file
+			first = mapped.head.match(self.mm, 0, end)
+			matches = chain([first] if first else [], mapped.boundary.finditer(self.mm, 0, end))
+		else:
+			matches = mapped.boundary.finditer(self.mm, start - 1, end)
+		for m in matches:
+			pos = m.start(1)
+			if opened:
+				index.append(pos)	# End of previous message
+				opened = False
+			if m.group(1) == b'MSH':
+				index.append(pos)
+				opened = True
+		if opened:
+			index.append(end)
+		return index
+
+	def signature(self):
+		"""File size and modification time the index was built against"""
+		st = stat(self.fullpath)
+		return array('Q', [mapped.magic, st.st_size, st.st_mtime_ns])
+
+	def loadIndex(self):
+		"""Reads the sidecar index if it still matches the file"""
+		if not self.persist or not path.exists(self.idxpath):
+			return None
+		index = array('Q')
+		try:
+			with open(self.idxpath, 'rb') as f:
+				index.frombytes(f.read())
+		except OSError:
+			return None
+		if len(index) < 3 or index[0:3] != self.signature():
+			return None	# Stale, the file changed since it was indexed
+		return index[3:]
+
+	def saveIndex(self):
+		"""Writes the index to the sidecar file"""
+		try:
+			with open(self.idxpath + '.tmp', 'wb') as f:
+				self.signature().tofile(f)
+				self.index.tofile(f)
+			replace(self.idxpath + '.tmp', self.idxpath)
+		except OSError:
+			pass	# Read-only location, the index is rebuilt next time
+
+	def offsets(self, i):
+		"""Returns the start and end byte offsets of message i"""
+		self.load()
+		n = len(self)
+		if i < 0:
+			i += n
+		if i < 0 or i >= n:
+			raise IndexError('message index out of range')
+		return self.index[2*i], self.index[2*i+1]
+
+	def __len__(self):
+		self.load()
+		return len(self.index) // 2
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(len(self)))]
+		start, end = self.offsets(i)
+		return self.mm[start:end].decode('utf-8','ignore')
+
+	def __iter__(self):
+		self.load()
+		for i in range(len(self)):
+			msg = self[i]
+			self.stats.inc('messages')
+			self.stats.inc('bytes', len(msg))
+			yield msg
+
+	def reader(self,splitChar = False):
+		# Iterating the index for getMsg
+		self.generator = iter(self)
+
+	def close(self):
+		"""Unmapping and closing file"""
+		if self.mm is not None:
+			self.mm.close()
+			self.mm = None
+		if self.fh is not None:
+			self.fh.close()
+			self.fh = None
+		self.index = None
+
+#---------------------------------------#
+#  Class for splitting streamed bytes   #
+#  into complete HL7 messages           #
+#---------------------------------------#
+class splitter:
+	"""Incremental splitter returning messages once the next MSH (or batch segment) arrives"""
+	def __init__(self, offset=0):
+		self.buf = b''
+		self.base = offset		# Absolute offset of buf[0] in the stream
+		self.start = None		# Start of the open message in buf
+		self.resume = 0			# Where the next boundary search starts in buf
+		self.fresh = True		# buf begins at the start of a line
+
+	def feed(self, data):
+		"""Adds bytes, returning (message bytes, end offset) for every message now complete"""
+		buf = self.buf = self.buf + data
+		out = []
+		matches = mapped.boundary.finditer(buf, self.resume)
+		if self.fresh:
+			# The first segment has no line ending in front of it
+			if len(buf) < 4:
+				return out
+			first = mapped.head.match(buf)
+			if first:
+				matches = chain([first], matches)
+			self.fresh = False
+		last = -1
+		for m in matches:
+			pos = m.start(1)
+			if self.start is not None:
+				out.append((buf[self.start:pos], self.base + pos))
+				self.start = None
+			if m.group(1) == b'MSH':
+				self.start = pos
+			last = m.start()
+
+		# Next search skips matched boundaries but rescans a tail that may be a partial one
+		resume = max(last + 1, len(buf) - 4, 0)
+		keep = self.start if self.start is not None else resume
+		self.buf = buf[keep:]
+		self.base += keep
+		self.resume = resume - keep
+		if self.start is not None:
+			self.start = 0
+		return out
+
+	def flush(self):
+		"""Returns the open message at the end of the stream as (message bytes, end offset)"""
+		if self.start is None:
+			return None
+		msg = (self.buf[self.start:], self.base + len(self.buf))
+		self.base += len(self.buf)
+		self.buf = b''
+		self.start = None
+		self.resume = 0
+		return msg
+
+#---------------------------------------#
+#  Class for polling drop directories   #
+#---------------------------------------#
+class directory:
+	"""Polls a drop directory, processing new files concurrently"""
+	def __init__(self,path,pattern='*',done='done',error='error',workers=4,order='mtime',processes=False,stale=3600):
+		self.path = path.replace('\\','/').rstrip('/')
+		self.pattern = pattern
+		self.done = self.path + '/' + done		# Processed files are moved here
+		self.error = self.path + '/' + error	# Files that raised are moved here
+		self.workers = workers
+		self.order = order						# 'mtime', 'name' or None
+		self.processes = processes				# Process pool instead of thread pool
+		self.stale = stale						# Seconds before an abandoned claim is taken back
+		makedirs(self.done, exist_ok=True)
+		makedirs(self.error, exist_ok=True)
+		self.stats = metrics('directory', self.path)
+
+	def discover(self):
+		"""Lists files waiting in the directory in the configured order"""
+		found = []
+		for name in glob(self.path + '/' + self.pattern):
+			name = name.replace('\\','/')
+			if name.endswith('.working') or not path.isfile(name):
+				continue
+			try:
+				found.append((stat(name).st_mtime, name))
+			except FileNotFoundError:
+				continue	# Claimed by someone else while listing
+		if self.order == 'mtime':
+			found.sort()
+		elif self.order == 'name':
+			found.sort(key=lambda f: f[1])
+		return [name for mtime, name in found]
+
+	def claim(self,fullpath):
+		"""Claims a file by renaming it, None if another poller got it first"""
+		claimed = fullpath + '.working'
+		try:
+			rename(fullpath, claimed)
+			return claimed
+		except OSError:
+			return None
+
+	def recover(self):
+		"""Puts back claims older than stale seconds, left behind by a poller that died"""
+		if self.stale is None:
+			return
+		for claimed in glob(self.path + '/' + self.pattern + '.working'):
+			try:
+				# The rename that claimed the file set its change time
+				if time.time() - stat(claimed).st_ctime > self.stale:
+					rename(claimed, claimed[:-len('.working')])
+			except OSError:
+				continue	# Finished or recovered by someone else
+
+	def poll(self,callback,parsed=True):
+		"""Claims and processes every waiting file, returning a report per file"""
+		self.recover()
+		claims = []
+		for name in self.discover():
+			claimed = self.claim(name)
+			if claimed:
+				claims.append((name, claimed, stat(claimed).st_mtime))
+		if not claims:
+			return []
+		executor = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+		reports = []
+		try:
+			with executor(self.workers) as pool:
+				futures = [pool.submit(directory.work, claimed, callback, parsed) for name, claimed, mtime in claims]
+				for (name, claimed, mtime), future in zip(claims, futures):
+					try:
+						report = future.result()
+					except Exception as e:
+						# The pool itself failed, e.g. a callback that can't be pickled
+						report = {'messages':0,'error':f'{type(e).__name__}: {e}','results':[],'seconds':0.0}
+					report['file'] = name
+					
+					# Moving the file out of the drop directory
+					dest = self.error if report['error'] else self.done
+					report['moved'] = dest + '/' + path.basename(name)
+					replace(claimed, report['moved'])
+					report['latency'] = time.time() - mtime	# Arrival to done
+					self.stats.inc('files')
+					self.stats.inc('messages', report['messages'])
+					if report['error']:
+						self.stats.inc('errors')
+					self.stats.observe('file_latency', report['latency'])
+					reports.append(report)
+		finally:
+			# Handing back anything still claimed if we were interrupted
+			for name, claimed, mtime in claims:
+				if path.exists(claimed):
+					try:
+						rename(claimed, name)
+					except OSError:
+						pass
+		return reports
+
+	def run(self,callback,interval=1,parsed=True):
+		"""Polls forever, yielding a report for every file processed"""
+		while True:
+			reports = self.poll(callback, parsed)
+			for report in reports:
+				yield report
+			if not reports:
+				time.sleep(interval)
+
+	@staticmethod
+	def work(claimed,callback,parsed=True):
+		"""Pool worker running callback over every message in one file"""
+		began = time.perf_counter()
+		report = {'messages':0,'error':None,'results':[]}
+		try:
+			for msg in file(claimed).messages():
+				report['results'].append(callback(parse(msg) if parsed else msg))
+				report['messages'] += 1
+		except Exception as e:
+			report['error'] = f'{type(e).__name__}: {e}'
+		report['seconds'] = time.perf_counter() - began
+		return report
+
 #---------------------------------------#
 #  Class for ftp Reading and Writing    #
 #---------------------------------------#
@@ -1358,6 +2618,67 @@ class ftp:
 		"""Returns list of directory items"""
 		return self.ftp.dir()
 
+	def ls(self):
+		"""Returns (name, size, modified) for each file, using MLSD when the server has it"""
+		try:
+			return [(name, int(facts.get('size', -1)), facts.get('modify', ''))
+				for name, facts in self.ftp.mlsd(facts=['type', 'size', 'modify'])
+				if facts.get('type', 'file') == 'file']
+		except error_perm:
+			pass
+		# Falling back to NLST with SIZE and MDTM per file
+		self.ftp.voidcmd('TYPE I')
+		files = []
+		for name in self.ftp.nlst():
+			try:
+				size = self.ftp.size(name)
+			except error_perm:
+				continue	# Directories have no size
+			try:
+				modified = self.ftp.voidcmd('MDTM ' + name)[4:].strip()
+			except error_perm:
+				modified = ''
+			files.append((name, size if size is not None else -1, modified))
+		return files
+
+	def sync(self,local,pattern='*',name='',db='',callback=None,delete=False,rename=''):
+		"""Downloads only new or changed files against a manifest, returning their local paths"""
+		# Manifest of files already taken is kept in SQLite
+		if not name:
+			name = f'FTP_{self.address}'
+		manifest = database(name, db)
+		remote = self.ftp.pwd().rstrip('/')
+		seen = manifest.manifest()
+		makedirs(local, exist_ok=True)
+		downloaded = []
+		for fn, size, modified in self.ls():
+			if not fnmatch(fn, pattern):
+				continue
+			key = f'{remote}/{fn}'
+			if seen.get(key) == (size, modified):
+				continue	# Unchanged since the last sync
+
+			# Downloading under a temp name so a partial file is never picked up
+			dest = local.rstrip('/') + '/' + fn
+			try:
+				with open(dest + '.tmp', 'wb') as f:
+					self.ftp.retrbinary('RETR ' + fn, f.write)
+				replace(dest + '.tmp', dest)
+				if callback:
+					callback(dest)
+			except Exception:
+				continue	# Left out of the manifest so the next sync retries it
+			manifest.record(key, size, modified)
+			downloaded.append(dest)
+
+			# Clearing the file off the server once processed
+			if delete:
+				self.delete(fn)
+			elif rename:
+				self.rename(fn, rename.format(name=fn))
+		manifest.close()
+		return downloaded
+
 	def send(self,destname,data):
 		"""Sending data in either binary or ascii"""
 		try:
@@ -1379,6 +2700,12 @@ class ftp:
 
 	def get(self,destname,splitChar='MSH'):
 		"""Gets data in binary or ascii mode"""
+		if splitChar == 'MSH':
+			# Only splitting on MSH at the start of a segment
+			try:
+				return list(self.stream(destname))
+			except:
+				return False
 		try:
 			f = BytesIO()
 			self.ftp.retrbinary("RETR " + destname, f.write)
@@ -1395,6 +2722,43 @@ class ftp:
 		except:
 			return False
 
+	def stream(self,destname,blocksize=65536):
+		"""Retrieves a file in binary, yielding messages as they arrive with bounded memory"""
+		# Reading the data connection ourselves, retrbinary would push the whole file
+		# through its callback before we could yield anything
+		split = splitter()
+		self.ftp.voidcmd('TYPE I')
+		conn = self.ftp.transfercmd('RETR ' + destname)
+		finished = False
+		try:
+			while True:
+				data = conn.recv(blocksize)
+				if not data:
+					break
+				for msg, end in split.feed(data):
+					yield self.received(msg)
+			last = split.flush()
+			conn.close()
+			self.ftp.voidresp()
+			finished = True
+			if last:
+				yield self.received(last[0])
+		finally:
+			if not finished:
+				# Stopped early, closing the transfer to keep the control connection in step
+				conn.close()
+				try:
+					self.ftp.voidresp()
+				except Exception:
+					pass
+
+	def received(self,msg):
+		# Decoding a streamed message and queueing it
+		msg = msg.decode('utf-8','ignore')
+		if self.qFlag:
+			self.pId = self.q.insert(msg)
+		return msg
+
 	def delete(self,file):
 		"""Deletes from from ftp host"""
 		try:
@@ -1423,6 +2787,125 @@ class ftp:
 		"""Closes FTP connection"""
 		self.ftp.quit()
 
+	class pool():
+		"""Keeps several logged in FTP connections and spreads transfers across them"""
+		def __init__(self,address,usr,pwd,port=21,size=4,retries=1,timeout=30):
+			self.address = address
+			self.port = port
+			self.usr = usr
+			self.pwd = pwd
+			self.size = size
+			self.retries = retries		# Reconnect and retry this many times per transfer
+			self.timeout = timeout		# Seconds to wait for a free connection
+			self.idle = Queue()			# Connections not in use
+			self.created = 0
+			self.lock = threading.Lock()
+			self.reconnects = 0
+
+		def acquire(self):
+			"""Takes an idle connection, logging a new one in while under size"""
+			deadline = time.monotonic() + self.timeout
+			while True:
+				with self.lock:
+					if self.idle.empty() and self.created < self.size:
+						self.created += 1
+						break
+				# Waking now and then in case a dropped connection freed a slot
+				left = deadline - time.monotonic()
+				if left <= 0:
+					raise TimeoutError(f'No FTP connection free within {self.timeout} seconds')
+				try:
+					return self.idle.get(timeout=min(.1, left))
+				except Empty:
+					continue
+			try:
+				cnxn = ftp(self.address, self.port)
+				cnxn.connect(self.usr, self.pwd)
+				return cnxn
+			except:
+				with self.lock:
+					self.created -= 1
+				raise
+
+		def release(self,cnxn,broken=False):
+			"""Returns a connection, dropping it if the session broke"""
+			if not broken:
+				self.idle.put(cnxn)
+				return
+			try:
+				cnxn.ftp.close()
+			except Exception:
+				pass
+			with self.lock:
+				self.created -= 1
+
+		def call(self,action,item):
+			"""Runs one transfer on a pooled connection, reconnecting failed sessions"""
+			for attempt in range(self.retries + 1):
+				try:
+					cnxn = self.acquire()
+				except all_errors:
+					continue
+				broken = True	# Until the action says otherwise, e.g. a bad item raised
+				try:
+					ret = action(cnxn, item)
+					broken = False
+					return ret
+				except error_perm:
+					# Server refused, e.g. no such file, the session is fine
+					broken = False
+					return False
+				except all_errors:
+					self.reconnects += 1
+				finally:
+					self.release(cnxn, broken)
+			return False
+
+		def map(self,action,items):
+			"""Runs action(connection, item) for every item in parallel, results in order"""
+			items = list(items)
+			with ThreadPoolExecutor(self.size) as executor:
+				return list(executor.map(lambda item: self.call(action, item), items))
+
+		def get(self,names):
+			"""Retrieves files, returning a list of messages per file or False"""
+			return self.map(lambda cnxn, name: list(cnxn.stream(name)), names)
+
+		def put(self,items):
+			"""Stores (destname, data) pairs in binary"""
+			def store(cnxn, item):
+				destname, data = item
+				if isinstance(data, str):
+					data = data.encode()
+				cnxn.ftp.storbinary('STOR ' + destname, BytesIO(data))
+				return True
+			return self.map(store, items)
+
+		def delete(self,names):
+			"""Deletes files"""
+			def dele(cnxn, name):
+				cnxn.ftp.delete(name)
+				return True
+			return self.map(dele, names)
+
+		def rename(self,pairs):
+			"""Renames (old, new) pairs"""
+			def move(cnxn, pair):
+				cnxn.ftp.rename(*pair)
+				return True
+			return self.map(move, pairs)
+
+		def close(self):
+			"""Logs out every idle connection"""
+			while not self.idle.empty():
+				cnxn = self.idle.get()
+				try:
+					cnxn.close()
+				except all_errors:
+					pass
+				with self.lock:
+					self.created -= 1
+
 #---------------------------------------#
 # Class for SQLite3 Reading and Writing #
 #---------------------------------------#
@@ -1434,30 +2917,176 @@ class queue:
 		self.qId = self.q.getId(name)
 		self.pId = None
 		self.qFlag = True
+		self.owner = str(uuid4())[24:36]	# Consumer name on claimed rows
+		self.stats = metrics('queue', name)
 		
-	def getMsg(self):
-		# Getting top message with Processed flag = 0
-		row = self.q.query()
-		while not row:
-			row = self.q.query()
-			continue
+	def getMsg(self, timeout=None):
+		# Getting top message with Processed flag = 0, None if nothing arrives within timeout
+		row = self.q.wait(timeout)
+		if not row:
+			return None
 		self.pId = row[0]
-		encodedMsg = row[1]
-		msg = base64.b64decode(encodedMsg.encode()).decode()
+		msg = row[1]
 		self.updateMsg(self.pId)
+		self.stats.inc('messages')
+		self.stats.inc('bytes', len(msg))
 		return msg	
 		
+	def getMany(self, n=100, lease=30, timeout=None):
+		# Claiming up to n messages for lease seconds, acknowledge them with ack
+		rows = self.q.wait(timeout, fetch=lambda: self.q.claim(n, lease, self.owner))
+		if not rows:
+			return []
+		self.stats.inc('messages', len(rows))
+		self.stats.inc('bytes', sum(len(row[1]) for row in rows))
+		return rows
+		
+	def ack(self, ids):
+		# Marking claimed messages processed, returns how many were still ours
+		return self.q.ack(ids, self.owner)
+		
+	def release(self, ids):
+		# Putting claimed messages back for another consumer
+		self.q.release(ids, self.owner)
+		return True
+		
 	def updateMsg(self, id):
 		self.q.update(id)
 		return True
 		
 	def send(self, msg):
 		self.q.insert(msg)
+		self.stats.inc('sent')
 		return True
 		
 	def export(self, filename=''):
 		self.q.export(filename)
 
+#---------------------------------------#
+#   Queue spread across SQLite files    #
+#---------------------------------------#
+class sharded:
+	"""Queue hashed across several SQLite files by a key such as PID-3"""
+	def __init__(self, name='', db='', shards=4, key=None, assigned=None):
+		# One queue per file, so writers to different shards don't share a lock
+		if not db:
+			db = 'queues.db'
+		base, ext = path.splitext(db)
+		if not ext:
+			ext = '.db'
+		self.shards = []
+		for i in range(shards):
+			q = queue(name, f'{base}_{i}{ext}')
+			q.stats.name = f'{name}_{i}'
+			self.shards.append(q)
+		self.key = key or self.patient
+		# Shards this consumer reads, all of them unless assigned
+		self.assigned = list(range(shards)) if assigned is None else list(assigned)
+		self.next = 0
+		self.pId = None
+		self.qFlag = True
+		
+	@staticmethod
+	def assign(worker, workers, shards):
+		"""Returns the shards for consumer number worker out of workers"""
+		return [i for i in range(shards) if i % workers == worker]
+		
+	@staticmethod
+	def patient(msg):
+		"""Returns the PID-3 identifier so each patient's messages stay on one shard in order"""
+		i = msg.find('\rPID')
+		if i == -1:
+			i = msg.find('\nPID')
+			if i == -1:
+				return ''
+		end = msg.find('\r', i + 1)
+		seg = msg[i+1:end if end != -1 else len(msg)]
+		fld, comp, rep = (msg[3], msg[4], msg[5]) if msg.startswith('MSH') and len(msg) > 5 else ('|', '^', '~')
+		fields = seg.split(fld)
+		if len(fields) < 4:
+			return ''
+		return fields[3].split(rep)[0].split(comp)[0]
+		
+	def shard(self, msg):
+		"""Returns the index of the shard msg belongs on"""
+		return zlib.crc32(self.key(msg).encode()) % len(self.shards)
+		
+	def send(self, msg):
+		return self.shards[self.shard(msg)].send(msg)
+		
+	def take(self, fetch, timeout=None):
+		"""Rotates over the assigned shards until fetch returns something, blocking on one shard at a time"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		count = len(self.assigned)
+		delay = .001
+		while True:
+			for i in range(count):
+				idx = self.assigned[self.next % count]
+				self.next += 1
+				result = fetch(idx, 0)
+				if result is not None:
+					return idx, result
+			# Nothing waiting, the other shards get checked again after delay
+			wait = delay
+			if deadline is not None:
+				wait = min(delay, deadline - time.monotonic())
+				if wait <= 0:
+					return None, None
+			idx = self.assigned[self.next % count]
+			self.next += 1
+			result = fetch(idx, wait)
+			if result is not None:
+				return idx, result
+			delay = min(delay * 2, .05)
+			
+	def getMsg(self, timeout=None):
+		# Getting the next message from the assigned shards, None if nothing arrives within timeout
+		idx, msg = self.take(lambda idx, wait: self.shards[idx].getMsg(wait), timeout)
+		if idx is None:
+			return None
+		self.pId = (idx, self.shards[idx].pId)
+		return msg
+		
+	def getMany(self, n=100, lease=30, timeout=None):
+		# Claiming up to n messages from one shard, keyed by (shard, id) for ack
+		idx, rows = self.take(lambda idx, wait: self.shards[idx].getMany(n, lease, wait) or None, timeout)
+		if idx is None:
+			return []
+		return [((idx, id), msg) for id, msg in rows]
+		
+	def ack(self, keys):
+		# Marking claimed messages processed, returns how many were still ours
+		return sum(self.shards[idx].ack(ids) for idx, ids in self.group(keys).items())
+		
+	def release(self, keys):
+		# Putting claimed messages back for another consumer
+		for idx, ids in self.group(keys).items():
+			self.shards[idx].release(ids)
+		return True
+		
+	@staticmethod
+	def group(keys):
+		"""Groups (shard, id) keys by shard"""
+		groups = {}
+		for idx, id in keys:
+			groups.setdefault(idx, []).append(id)
+		return groups
+		
+	def depth(self):
+		# Messages waiting across every shard
+		return sum(q.q.depth() for q in self.shards)
+		
+	def export(self, filename=''):
+		# Exporting every shard to one file, shard by shard
+		if not filename:
+			filename = f'Q_{self.shards[0].qId}.txt'
+		for q in self.shards:
+			q.export(filename)
+			
+	def close(self):
+		for q in self.shards:
+			q.q.close()
+
 #---------------------------------------#
 #       Class for HTTPS Requests        #
 #---------------------------------------#
@@ -1597,6 +3226,114 @@ class rest:
 		
 		return resp
 
+#---------------------------------------#
+#  Class for transport metrics and an   #
+#  optional Prometheus HTTP endpoint    #
+#---------------------------------------#
+class metrics:
+	"""Per-instance message counters and latency histograms"""
+	instances = weakref.WeakSet()	# Every live metrics object, read by the endpoint
+	buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+	count = 0
+
+	def __init__(self, kind, name=''):
+		self.kind = kind
+		self.name = str(name)
+		metrics.count += 1
+		self.instance = metrics.count
+		self.counters = {'messages':0,'bytes':0,'errors':0,'reconnects':0}
+		self.histograms = {}	# name -> [bucket counts, sum, count]
+		metrics.instances.add(self)
+
+	def inc(self, counter, n=1):
+		"""Adds n to a counter"""
+		self.counters[counter] = self.counters.get(counter, 0) + n
+
+	def observe(self, name, seconds):
+		"""Records a latency in seconds"""
+		h = self.histograms.get(name)
+		if h is None:
+			h = self.histograms[name] = [[0] * (len(metrics.buckets) + 1), 0.0, 0]
+		h[0][bisect_left(metrics.buckets, seconds)] += 1
+		h[1] += seconds
+		h[2] += 1
+
+	def snapshot(self):
+		"""Returns counters and cumulative histograms as a dictionary"""
+		histograms = {}
+		for name, (counts, total, n) in list(self.histograms.items()):
+			cumulative = {}
+			running = 0
+			for le, c in zip(metrics.buckets + ('+Inf',), counts):
+				running += c
+				cumulative[str(le)] = running
+			histograms[name] = {'buckets':cumulative,'sum':total,'count':n}
+		return {
+			'kind': self.kind,
+			'name': self.name,
+			'instance': self.instance,
+			'counters': dict(self.counters),
+			'histograms': histograms
+		}
+
+	@staticmethod
+	def all():
+		"""Snapshots of every live instance"""
+		return [m.snapshot() for m in sorted(list(metrics.instances), key=lambda m: m.instance)]
+
+	@staticmethod
+	def prometheus():
+		"""Renders every live instance in Prometheus text format"""
+		counters = {}
+		histograms = {}
+		for snap in metrics.all():
+			name = snap['name'].replace('\\','\\\\').replace('"','\\"')
+			labels = f'kind="{snap["kind"]}",name="{name}",instance="{snap["instance"]}"'
+			for k, v in snap['counters'].items():
+				counters.setdefault(k, []).append(f'hl7_{k}_total{{{labels}}} {v}')
+			for k, h in snap['histograms'].items():
+				lines = histograms.setdefault(k, [])
+				for le, v in h['buckets'].items():
+					lines.append(f'hl7_{k}_seconds_bucket{{{labels},le="{le}"}} {v}')
+				lines.append(f'hl7_{k}_seconds_sum{{{labels}}} {h["sum"]}')
+				lines.append(f'hl7_{k}_seconds_count{{{labels}}} {h["count"]}')
+		out = []
+		for k, lines in counters.items():
+			out.append(f'# TYPE hl7_{k}_total counter')
+			out.extend(lines)
+		for k, lines in histograms.items():
+			out.append(f'# TYPE hl7_{k}_seconds histogram')
+			out.extend(lines)
+		return '\n'.join(out) + '\n'
+
+	@staticmethod
+	def serve(port=9100, host=''):
+		"""Serves /metrics (Prometheus) and /metrics.json from a background thread"""
+		class handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.startswith('/metrics.json'):
+					body = json.dumps(metrics.all()).encode()
+					ctype = 'application/json'
+				elif self.path.startswith('/metrics'):
+					body = metrics.prometheus().encode()
+					ctype = 'text/plain; version=0.0.4'
+				else:
+					self.send_error(404)
+					return
+				self.send_response(200)
+				self.send_header('Content-Type', ctype)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass	# Scrapes aren't worth logging
+
+		httpd = ThreadingHTTPServer((host, port), handler)
+		httpd.daemon_threads = True
+		threading.Thread(target=httpd.serve_forever, daemon=True).start()
+		return httpd
+
 #---------------------------------------#
 #  Class SQLite database logging for    #
 #  Connections above				    #
@@ -1604,8 +3341,59 @@ class rest:
 #---------------------------------------#
 class database:
 	"""Uses SQLite for logging message"""
-	def __init__(self, tblName='', dbName='', days=30):
+	# Keys of received messages for tcp.server duplicate suppression
+	seen_schema = """
+		CREATE TABLE IF NOT EXISTS seen (
+		strInstanceId TEXT
+		,strKey TEXT
+		,dtAdded REAL
+		,PRIMARY KEY (strInstanceId, strKey)
+	)
+	"""
+	
+	# Files already downloaded by ftp.sync
+	manifest_schema = """
+		CREATE TABLE IF NOT EXISTS manifest (
+		strInstanceId TEXT
+		,strName TEXT
+		,intSize INTEGER
+		,strModified TEXT
+		,dtUpdated DATETIME
+		,PRIMARY KEY (strInstanceId, strName)
+	)
+	"""
+	
+	# Read positions of files followed with file.follow
+	offsets_schema = """
+		CREATE TABLE IF NOT EXISTS offsets (
+		strInstanceId TEXT
+		,strKey TEXT
+		,intOffset INTEGER
+		,strIdent TEXT
+		,dtUpdated DATETIME
+		,PRIMARY KEY (strInstanceId, strKey)
+	)
+	"""
+	
+	# Payload encodings in intCodec, NULL is the original base64 text
+	RAW, ZLIB, LZMA = 0, 1, 2
+	codecs = {'zlib': ZLIB, 'lzma': LZMA}
+	
+	# (database file, queue id) -> [Condition, commits] shared by the connections in this process
+	signals = {}
+	signalsLock = threading.Lock()
+	
+	def __init__(self, tblName='', dbName='', days=30, autocheckpoint=1000):
 		self.qId = str(uuid4())[24:36] # Create GUID (last section)
+		# Storing payloads as is unless compression is turned on
+		self.codec = self.RAW
+		self.threshold = 0
+		# Committing every insert unless batching is turned on
+		self.batch = 1
+		self.interval = 0
+		self.pending = 0
+		self.oldest = 0
+		self.signal = None
 		# Saving database name
 		if not dbName:
 			dbName = 'queues.db'
@@ -1616,13 +3404,15 @@ class database:
 			tblName = self.qId # Default to GUID
 			self.conn = sqlite3.connect(dbName)
 			self.cursor = self.conn.cursor()
+			self.cursor.execute('PRAGMA auto_vacuum=INCREMENTAL;')	# Only takes on a new file
 			return None # We don't create a table, but connect to database
 			
 		tblName = tblName.upper()
 
-		# Connecting to database
+		# Connecting to database, new files free pages as the pruner asks
 		self.conn = sqlite3.connect(dbName)
 		self.cursor = self.conn.cursor()
+		self.cursor.execute('PRAGMA auto_vacuum=INCREMENTAL;')
 		
 		# Setting table name
 		txtName = tblName
@@ -1641,7 +3431,7 @@ class database:
 		)
 		"""
 		self.cursor.execute(queue_schema)
-		self.cursor.execute(f'SELECT strInstanceId FROM queues WHERE strName=\'{txtName}\'')
+		self.cursor.execute('SELECT strInstanceId FROM queues WHERE strName=?', (txtName,))
 		row = self.cursor.fetchone()
 		if row:
 			# If it is an existing entry return the row
@@ -1650,24 +3440,47 @@ class database:
 			#return self.qId
 		else:
 			# Create the new entry and table
-			self.cursor.execute(f'INSERT INTO queues (strInstanceId,strName) VALUES (\'{self.qId}\',\'{txtName}\')')
+			self.cursor.execute('INSERT INTO queues (strInstanceId,strName) VALUES (?,?)', (self.qId, txtName))
 			self.conn.commit()
 			
 			# Create queue table if it doesn't exist
 			msgs_schema = f"""
 				CREATE TABLE IF NOT EXISTS \'{tblName}\' (
 				ID INTEGER PRIMARY KEY AUTOINCREMENT
-				,txtMsg TEXT
+				,txtMsg BLOB
 				,dtAdded DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
 				,dtUpdated DATETIME
 				,intProcessed BOOLEAN NOT NULL DEFAULT 0
 				,intParentId INTEGER
+				,intCodec INTEGER
+				,strClaimedBy TEXT
+				,dtLeaseExpiry REAL
 			)
 			"""
 			self.cursor.execute(msgs_schema)
 			
-		# Disabling journal and sync for speed
-		self.cursor.execute('PRAGMA journal_mode=MEMORY;')
+		# Sharing a wake up signal with other connections to this queue
+		key = (path.abspath(dbName) if dbName != ':memory:' else id(self), self.qId)
+		with self.signalsLock:
+			self.signal = self.signals.setdefault(key, [threading.Condition(), 0])
+			
+		# Upgrading older queue tables, their base64 rows keep a NULL codec
+		self.cursor.execute(f'PRAGMA table_info("{tblName}")')
+		columns = [col[1] for col in self.cursor.fetchall()]
+		for column, kind in (('intCodec', 'INTEGER'), ('strClaimedBy', 'TEXT'), ('dtLeaseExpiry', 'REAL')):
+			if column not in columns:
+				self.cursor.execute(f'ALTER TABLE "{tblName}" ADD COLUMN {column} {kind}')
+				
+		# Indexing only the unprocessed rows so dequeues don't slow down as the table grows
+		self.cursor.execute(f'CREATE INDEX IF NOT EXISTS "IX_{tblName}_UNPROCESSED" ON "{tblName}" (ID) WHERE intProcessed=0')
+		self.cursor.execute(f'CREATE INDEX IF NOT EXISTS "IX_{tblName}_ADDED" ON "{tblName}" (dtAdded)')
+			
+		# WAL lets readers carry on during writes, memory databases keep an in memory journal
+		if dbName == ':memory:':
+			self.cursor.execute('PRAGMA journal_mode=MEMORY;')
+		else:
+			self.cursor.execute('PRAGMA journal_mode=WAL;')
+			self.cursor.execute(f'PRAGMA wal_autocheckpoint={int(autocheckpoint)};')
 		self.cursor.execute('PRAGMA synchronous=NORMAL;')
 		self.conn.commit()
 		
@@ -1677,63 +3490,508 @@ class database:
 		name = name.upper()
 		if not db:
 			db = 'queues'
-		sql = f'SELECT strInstanceId FROM {db} WHERE strName="{name}" AND intActive=1'
-		self.cursor.execute(sql)
+		sql = f'SELECT strInstanceId FROM {db} WHERE strName=? AND intActive=1'
+		self.cursor.execute(sql, (name,))
 		row = self.cursor.fetchone()
 		return row[0]
 		
+	def compression(self, codec='zlib', threshold=4096):
+		# Compressing payloads of at least threshold bytes with zlib or lzma
+		self.codec = self.codecs[codec] if codec else self.RAW
+		self.threshold = threshold
+		
+	def encode(self, msg):
+		# Returning the stored payload and its codec
+		if self.codec and len(msg) >= self.threshold:
+			data = msg.encode()
+			if self.codec == self.ZLIB:
+				return zlib.compress(data), self.ZLIB
+			return lzma.compress(data), self.LZMA
+		return msg, self.RAW
+		
+	@classmethod
+	def decode(cls, payload, codec):
+		# Returning the message text from a stored payload
+		if codec is None:
+			return base64.b64decode(payload.encode()).decode()
+		if codec == cls.ZLIB:
+			return zlib.decompress(payload).decode()
+		if codec == cls.LZMA:
+			return lzma.decompress(payload).decode()
+		return payload
+		
 	def insert(self, msg, parent=None):
 		tblName = 'Q_' + self.qId
-		encodedMsg = base64.b64encode(msg.encode()).decode()	# Base64 encoding message
-		sql = f'INSERT INTO "{tblName}" (txtMsg, intParentId) VALUES (?, ?)'
-		params = (encodedMsg, parent)
+		sql = f'INSERT INTO "{tblName}" (txtMsg, intCodec, intParentId) VALUES (?, ?, ?)'
+		params = (*self.encode(msg), parent)
 		self.cursor.execute(sql, params)
 		lastId = self.cursor.lastrowid
-		self.conn.commit()
+		self.commit()
 		
 		return lastId
 		
+	def insert_many(self, msgs, parent=None):
+		# Inserting several messages in one statement and returning their IDs
+		tblName = 'Q_' + self.qId
+		sql = f'INSERT INTO "{tblName}" (txtMsg, intCodec, intParentId) VALUES (?, ?, ?)'
+		params = [(*self.encode(msg), parent) for msg in msgs]
+		if not params:
+			return []
+		self.cursor.executemany(sql, params)
+		# IDs are consecutive within the transaction on this connection
+		self.cursor.execute('SELECT last_insert_rowid()')
+		lastId = self.cursor.fetchone()[0]
+		self.commit(len(params))
+		
+		return list(range(lastId - len(params) + 1, lastId + 1))
+		
+	def batching(self, size=100, interval=.05):
+		# Group committing inserts every size messages or interval seconds
+		self.batch = size
+		self.interval = interval
+		
+	def commit(self, count=1):
+		# Committing once the batch is full or the oldest pending insert has waited long enough
+		now = time.monotonic()
+		if not self.pending:
+			self.oldest = now
+		self.pending += count
+		if self.pending >= self.batch or now - self.oldest >= self.interval:
+			self.flush()
+			
+	def flush(self):
+		# Committing any pending inserts, returns True if there were some
+		if not self.pending:
+			return False
+		self.conn.commit()
+		self.pending = 0
+		self.notify()
+		return True
+		
+	def notify(self):
+		# Waking consumers of this queue in the same process
+		if self.signal:
+			with self.signal[0]:
+				self.signal[1] += 1
+				self.signal[0].notify_all()
+				
+	def wait(self, timeout=None, backoff=.05, fetch=None):
+		# Returning the next unprocessed row (or what fetch returns), or None once timeout seconds pass
+		if fetch is None:
+			fetch = self.query
+		deadline = None if timeout is None else time.monotonic() + timeout
+		signal = self.signal
+		delay = .001
+		while True:
+			commits = signal[1]
+			version = self.cursor.execute('PRAGMA data_version').fetchone()[0]
+			row = fetch()
+			if row:
+				return row
+			while True:
+				if deadline is not None:
+					left = deadline - time.monotonic()
+					if left <= 0:
+						return None
+					delay = min(delay, left)
+				# Inserts in this process signal, other processes show up in data_version
+				with signal[0]:
+					if signal[1] == commits:
+						signal[0].wait(delay)
+				if signal[1] != commits or self.cursor.execute('PRAGMA data_version').fetchone()[0] != version:
+					delay = .001
+					break
+				delay = min(delay * 2, backoff)
+		
+	def due(self):
+		# Pending inserts have waited longer than the batch interval
+		return self.pending and time.monotonic() - self.oldest >= self.interval
+		
 	def query(self, id=None):
 		tblName = 'Q_' + self.qId
-		sql = f'SELECT ID, txtMsg FROM {tblName} WHERE intProcessed=0 ORDER BY ID LIMIT 1'
-		self.cursor.execute(sql)
+		# Skipping rows leased to a consumer by claim
+		sql = f'SELECT ID, txtMsg, intCodec FROM {tblName} WHERE intProcessed=0 AND (dtLeaseExpiry IS NULL OR dtLeaseExpiry<?) ORDER BY ID LIMIT 1'
+		self.cursor.execute(sql, (time.time(),))
 		row = self.cursor.fetchone()
+		if row:
+			return row[0], self.decode(row[1], row[2])
 		return row
 		
+	def claim(self, n, lease=30, owner=''):
+		# Leasing up to n unprocessed rows to owner for lease seconds, expired leases are claimable again
+		tblName = 'Q_' + self.qId
+		self.flush()
+		if self.conn.in_transaction:
+			self.conn.commit()
+		now = time.time()
+		# Taking the write lock first so two consumers can't select the same rows
+		self.cursor.execute('BEGIN IMMEDIATE')
+		try:
+			sql = f'SELECT ID, txtMsg, intCodec FROM "{tblName}" WHERE intProcessed=0 AND (dtLeaseExpiry IS NULL OR dtLeaseExpiry<?) ORDER BY ID LIMIT ?'
+			self.cursor.execute(sql, (now, n))
+			rows = self.cursor.fetchall()
+			sql = f'UPDATE "{tblName}" SET strClaimedBy=?, dtLeaseExpiry=? WHERE ID=?'
+			self.cursor.executemany(sql, [(owner, now + lease, row[0]) for row in rows])
+			self.conn.commit()
+		except Exception:
+			self.conn.rollback()
+			raise
+		return [(row[0], self.decode(row[1], row[2])) for row in rows]
+		
+	def ack(self, ids, owner=''):
+		# Marking claimed rows processed, returns how many were still leased to owner
+		tblName = 'Q_' + self.qId
+		sql = f'UPDATE "{tblName}" SET intProcessed=1, dtUpdated=CURRENT_TIMESTAMP, dtLeaseExpiry=NULL WHERE ID=? AND strClaimedBy=? AND intProcessed=0'
+		self.cursor.executemany(sql, [(id, owner) for id in ids])
+		count = self.cursor.rowcount
+		self.conn.commit()
+		self.pending = 0
+		return count
+		
+	def release(self, ids, owner=''):
+		# Returning claimed rows to the queue before their lease runs out
+		tblName = 'Q_' + self.qId
+		sql = f'UPDATE "{tblName}" SET strClaimedBy=NULL, dtLeaseExpiry=NULL WHERE ID=? AND strClaimedBy=? AND intProcessed=0'
+		self.cursor.executemany(sql, [(id, owner) for id in ids])
+		self.conn.commit()
+		self.pending = 0
+		self.notify()
+		
+	def depth(self, inbound=False):
+		# Number of messages waiting to be processed, inbound leaves out the ACKs logged against them
+		tblName = 'Q_' + self.qId
+		if inbound:
+			self.cursor.execute(f'SELECT COUNT(*) FROM "{tblName}" WHERE intProcessed=0 AND intParentId IS NULL')
+		else:
+			self.cursor.execute(f'SELECT COUNT(*) FROM "{tblName}" WHERE intProcessed=0')
+		return self.cursor.fetchone()[0]
+		
 	def update(self, id):
 		tblName = 'Q_' + self.qId
-		sql = f'UPDATE {tblName} SET intProcessed=1,dtUpdated=CURRENT_TIMESTAMP WHERE ID={id}'
-		self.cursor.execute(sql)
+		sql = f'UPDATE "{tblName}" SET intProcessed=1,dtUpdated=CURRENT_TIMESTAMP WHERE ID=?'
+		self.cursor.execute(sql, (id,))
 		self.conn.commit()
+		if self.pending:
+			# Pending inserts went out with it
+			self.pending = 0
+			self.notify()
 		return True
 		
+	def remember(self, keys):
+		# Persisting seen message keys in one transaction, a None time deletes the key, table is created by recall
+		sql = 'INSERT OR REPLACE INTO seen (strInstanceId, strKey, dtAdded) VALUES (?, ?, ?)'
+		self.cursor.executemany(sql, [(self.qId, key, added) for key, added in keys.items() if added is not None])
+		sql = 'DELETE FROM seen WHERE strInstanceId=? AND strKey=?'
+		self.cursor.executemany(sql, [(self.qId, key) for key, added in keys.items() if added is None])
+		self.conn.commit()
+		
+	def recall(self, ttl):
+		# Dropping expired keys and returning the rest oldest first
+		self.cursor.execute(self.seen_schema)
+		cutoff = time.time() - ttl
+		self.cursor.execute('DELETE FROM seen WHERE strInstanceId=? AND dtAdded<?', (self.qId, cutoff))
+		self.conn.commit()
+		self.cursor.execute('SELECT strKey, dtAdded FROM seen WHERE strInstanceId=? ORDER BY dtAdded', (self.qId,))
+		return self.cursor.fetchall()
+		
+	def position(self, key):
+		# Returning the checkpointed offset and file identity for a followed file
+		self.cursor.execute(self.offsets_schema)
+		sql = 'SELECT intOffset, strIdent FROM offsets WHERE strInstanceId=? AND strKey=?'
+		self.cursor.execute(sql, (self.qId, key))
+		row = self.cursor.fetchone()
+		if row:
+			return row[0], row[1]
+		return 0, None
+		
+	def checkpoint(self, key, offset, ident):
+		# Saving the offset after the last processed message, table is created by position
+		sql = 'INSERT OR REPLACE INTO offsets (strInstanceId, strKey, intOffset, strIdent, dtUpdated) VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)'
+		self.cursor.execute(sql, (self.qId, key, offset, ident))
+		self.conn.commit()
+		
+	def manifest(self):
+		# Returning {remote path: (size, modified)} of files synced from FTP
+		self.cursor.execute(self.manifest_schema)
+		sql = 'SELECT strName, intSize, strModified FROM manifest WHERE strInstanceId=?'
+		self.cursor.execute(sql, (self.qId,))
+		return {row[0]: (row[1], row[2]) for row in self.cursor.fetchall()}
+		
+	def record(self, name, size, modified):
+		# Adding a synced file to the manifest, table is created by manifest
+		sql = 'INSERT OR REPLACE INTO manifest (strInstanceId, strName, intSize, strModified, dtUpdated) VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)'
+		self.cursor.execute(sql, (self.qId, name, size, modified))
+		self.conn.commit()
+		
+	def walCheckpoint(self, mode='PASSIVE'):
+		# Copying the WAL into the database file, TRUNCATE also shrinks the WAL back to zero
+		self.flush()
+		self.cursor.execute(f'PRAGMA wal_checkpoint({mode});')
+		return self.cursor.fetchone()
+		
 	def close(self):
 		# Closing connections
+		self.flush()
 		self.cursor.close()
 		self.conn.close()
 		
-	def pruner(self):
-		# Pruning messages
+	def prune(self, size=1000, vacuum=1000):
+		# Deleting expired messages size IDs at a time, yielding the count after each commit
+		self.flush()
 		sql = 'SELECT strInstanceId,intPurgeDays FROM queues'
 		self.cursor.execute(sql)
 		rows = self.cursor.fetchall()
 		for row in rows:
 			tblName = f'Q_{row[0]}'
-			delta = row[1]
-			sql = f"DELETE FROM {tblName} WHERE dtAdded < datetime('now', '-{delta} days')"
-			self.cursor.execute(sql)
-			self.conn.commit()
+			cutoff = f'-{row[1]} days'
+			# IDs rise with dtAdded, so the dtAdded index bounds the range to delete
+			sql = f"SELECT MIN(ID), MAX(ID) FROM \"{tblName}\" WHERE dtAdded < datetime('now', ?)"
+			try:
+				self.cursor.execute(sql, (cutoff,))
+			except sqlite3.OperationalError:
+				continue	# Queue table was dropped
+			low, high = self.cursor.fetchone()
+			if low is None:
+				continue
+			sql = f"DELETE FROM \"{tblName}\" WHERE ID>=? AND ID<? AND dtAdded < datetime('now', ?)"
+			while low <= high:
+				self.cursor.execute(sql, (low, min(low + size, high + 1), cutoff))
+				deleted = self.cursor.rowcount
+				self.conn.commit()
+				low += size
+				yield deleted
+		# Handing freed pages back to the file system a few at a time
+		if vacuum:
+			self.cursor.execute('PRAGMA auto_vacuum')
+			if self.cursor.fetchone()[0] == 2:
+				free = None
+				while True:
+					self.cursor.execute('PRAGMA freelist_count')
+					left = self.cursor.fetchone()[0]
+					if not left or left == free:
+						break
+					free = left
+					# executescript steps the pragma to the end, execute frees one page
+					self.cursor.executescript(f'PRAGMA incremental_vacuum({int(vacuum)});')
+					yield 0
+		
+	def pruner(self, size=1000, pause=.01, vacuum=1000):
+		# Pruning messages in batches, pausing between them so writers get the lock
+		total = 0
+		for deleted in self.prune(size, vacuum):
+			total += deleted
+			time.sleep(pause)
+		return total
+		
+	@staticmethod
+	def retention(dbName='', every=3600, size=1000, pause=.01, vacuum=1000):
+		"""Runs the pruner on a background thread every few seconds, set the returned event to stop it"""
+		stop = threading.Event()
+		def run():
+			# SQLite connections belong to the thread that opened them
+			db = database('', dbName)
+			while not stop.is_set():
+				try:
+					db.pruner(size, pause, vacuum)
+				except sqlite3.Error:
+					pass	# Locked or busy, trying again next round
+				stop.wait(every)
+			db.close()
+		threading.Thread(target=run, daemon=True).start()
+		return stop
 		
 	def export(self, filename=''):
 		# Exporting queue
 		tblName = 'Q_' + self.qId
 		if not filename:
 			filename = f'{tblName}.txt'
-		sql = f'SELECT txtMsg FROM {tblName}'
+		sql = f'SELECT txtMsg, intCodec FROM {tblName}'
 		self.cursor.execute(sql)
-		rows = self.cursor.fetchall()
-		for row in rows:
-			encodedMsg = row[0]
-			msg = base64.b64decode(encodedMsg.encode()).decode()
-			with open(filename, 'a') as f:
-				f.write(msg)
\ No newline at end of file
+		with open(filename, 'a') as f:
+			for row in self.cursor:
+				f.write(self.decode(row[0], row[1]))
+				
+	def migrate(self, size=1000):
+		# Rewriting base64 rows in the current format, size rows per commit
+		tblName = 'Q_' + self.qId
+		while True:
+			self.cursor.execute(f'SELECT ID, txtMsg FROM "{tblName}" WHERE intCodec IS NULL LIMIT ?', (size,))
+			rows = self.cursor.fetchall()
+			if not rows:
+				return
+			params = [(*self.encode(self.decode(row[1], None)), row[0]) for row in rows]
+			self.cursor.executemany(f'UPDATE "{tblName}" SET txtMsg=?, intCodec=? WHERE ID=?', params)
+			self.conn.commit()
+#---------------------------------------#
+#   Command line tools for capacity     #
+#   planning, python -m hl7 <command>   #
+#---------------------------------------#
+class bench:
+	"""Load generators measuring transport throughput and latency"""
+	@staticmethod
+	def message(size=1024, msgId='1'):
+		"""Builds a synthetic ORU message padded with OBX segments to about size bytes"""
+		stamp = datetime.strftime(datetime.now(),'%Y%m%d%H%M%S')
+		msg = f'MSH|^~\\&|BENCH|PYHL7|BENCH|PYHL7|{stamp}||ORU^R01|{msgId}|P|2.5\r'
+		msg += 'PID|1||12345^^^MRN||DOE^JOHN||19700101|M\r'
+		i = 1
+		while len(msg) < size:
+			obx = f'OBX|{i}|TX|BENCH^Bench||'
+			msg += obx + 'X' * max(1, min(200, size - len(msg) - len(obx) - 1)) + '\r'
+			i += 1
+		return msg
+
+	@staticmethod
+	def percentile(values, pct):
+		"""Nearest-rank percentile of sorted values"""
+		if not values:
+			return 0.0
+		k = max(0, min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1))
+		return values[k]
+
+	@staticmethod
+	def mllp(host=None, port=0, connections=4, messages=10000, size=1024, rate=0, timeout=5):
+		"""Sends messages over MLLP from concurrent connections and reports throughput and ACK latency"""
+		# Spinning up a local listener if no target was given
+		srv = None
+		if not host:
+			srv = tcp.server(port)
+			srv.start()
+			host = '127.0.0.1'
+			port = srv.port
+			def listen():
+				try:
+					while True:
+						srv.getMsg()
+				except StopIteration:
+					pass
+			threading.Thread(target=listen, daemon=True).start()
+
+		# Splitting the messages across the connections
+		counts = [messages // connections + (1 if i < messages % connections else 0) for i in range(connections)]
+		latencies = [[] for i in range(connections)]
+		errors = [0] * connections
+		ready = threading.Barrier(connections + 1)
+
+		def sender(n):
+			ob = tcp.client(host, port)
+			ob.setTimeout(timeout)
+			ob.setRetry(tcp.retry(attempts=1))
+			ob.start()
+			msgs = [bench.message(size, f'{n}-{i}') for i in range(min(counts[n], 100))]
+			interval = 1 / rate if rate else 0
+			ready.wait()
+			began = time.perf_counter()
+			for i in range(counts[n]):
+				if interval:
+					# Pacing each connection to the requested rate
+					delay = began + i * interval - time.perf_counter()
+					if delay > 0:
+						time.sleep(delay)
+				sent = time.perf_counter()
+				ack = ob.send(msgs[i % len(msgs)])
+				if ack and ob.evaluate(ack):
+					latencies[n].append(time.perf_counter() - sent)
+				else:
+					errors[n] += 1
+			ob.stop()
+
+		threads = [threading.Thread(target=sender, args=(n,), daemon=True) for n in range(connections)]
+		for t in threads:
+			t.start()
+		ready.wait()
+		began = time.perf_counter()
+		for t in threads:
+			t.join()
+		elapsed = time.perf_counter() - began
+		if srv:
+			srv.stop()
+
+		# Summarizing results
+		values = sorted(v for l in latencies for v in l)
+		acked = len(values)
+		return {
+			'host': host,
+			'port': port,
+			'connections': connections,
+			'size': len(bench.message(size)),
+			'messages': acked,
+			'errors': sum(errors),
+			'seconds': elapsed,
+			'msgs_per_sec': acked / elapsed if elapsed else 0.0,
+			'mb_per_sec': acked * len(bench.message(size)) / elapsed / 1e6 if elapsed else 0.0,
+			'p50_ms': bench.percentile(values, 50) * 1000,
+			'p90_ms': bench.percentile(values, 90) * 1000,
+			'p99_ms': bench.percentile(values, 99) * 1000,
+			'max_ms': values[-1] * 1000 if values else 0.0,
+		}
+
+	@staticmethod
+	def ftp(host='127.0.0.1', port=21, usr='anonymous', pwd='', sizes=(1, 2, 4, 8), pattern='*'):
+		"""Retrieves every matching file with pools of each size and reports throughput"""
+		lister = ftp(host, port)
+		lister.connect(usr, pwd)
+		names = [n for n in lister.ftp.nlst() if fnmatch(n, pattern)]
+		lister.close()
+		reports = []
+		for size in sizes:
+			p = ftp.pool(host, usr, pwd, port, size)
+			began = time.perf_counter()
+			results = p.get(names)
+			elapsed = time.perf_counter() - began
+			p.close()
+			messages = sum(len(r) for r in results if r)
+			reports.append({
+				'pool': size,
+				'files': len(names),
+				'failed': sum(1 for r in results if r is False),
+				'messages': messages,
+				'seconds': elapsed,
+				'files_per_sec': len(names) / elapsed if elapsed else 0.0,
+				'msgs_per_sec': messages / elapsed if elapsed else 0.0,
+			})
+		return reports
+
+def main(argv=None):
+	"""Command line entry point"""
+	import argparse
+	parser = argparse.ArgumentParser(prog='python -m hl7', description='pyHL7 command line tools')
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	mllp = commands.add_parser('bench-mllp', help='MLLP load generator and loopback benchmark')
+	mllp.add_argument('--host', default=None, help='Remote listener, default spins up a local tcp.server')
+	mllp.add_argument('--port', type=int, default=0, help='Remote or local listener port, 0 picks a free one')
+	mllp.add_argument('-c', '--connections', type=int, default=4, help='Concurrent sending connections')
+	mllp.add_argument('-n', '--messages', type=int, default=10000, help='Total messages to send')
+	mllp.add_argument('-s', '--size', type=int, default=1024, help='Approximate message size in bytes')
+	mllp.add_argument('-r', '--rate', type=float, default=0, help='Messages per second per connection, 0 is unlimited')
+	mllp.add_argument('-t', '--timeout', type=float, default=5, help='Seconds to wait on each ACK')
+
+	ftpBench = commands.add_parser('bench-ftp', help='FTP pool retrieval benchmark against an FTP server')
+	ftpBench.add_argument('--host', default='127.0.0.1', help='FTP server, default localhost')
+	ftpBench.add_argument('--port', type=int, default=21)
+	ftpBench.add_argument('--user', default='anonymous')
+	ftpBench.add_argument('--password', default='')
+	ftpBench.add_argument('--pattern', default='*', help='Files in the login directory to retrieve')
+	ftpBench.add_argument('--sizes', default='1,2,4,8', help='Comma separated pool sizes to compare')
+
+	args = parser.parse_args(argv)
+	if args.command == 'bench-mllp':
+		report = bench.mllp(args.host, args.port, args.connections, args.messages, args.size, args.rate, args.timeout)
+		print(f"Target       {report['host']}:{report['port']}")
+		print(f"Connections  {report['connections']}")
+		print(f"Message size {report['size']} bytes")
+		print(f"ACK'd        {report['messages']} ({report['errors']} errors) in {report['seconds']:.2f}s")
+		print(f"Throughput   {report['msgs_per_sec']:.0f} msgs/sec, {report['mb_per_sec']:.2f} MB/sec")
+		print(f"ACK latency  p50 {report['p50_ms']:.2f}ms  p90 {report['p90_ms']:.2f}ms  p99 {report['p99_ms']:.2f}ms  max {report['max_ms']:.2f}ms")
+		return report
+	if args.command == 'bench-ftp':
+		sizes = [int(n) for n in args.sizes.split(',')]
+		reports = bench.ftp(args.host, args.port, args.user, args.password, sizes, args.pattern)
+		print("Pool  Files  Failed  Messages  Seconds  Files/sec  Msgs/sec")
+		for r in reports:
+			print(f"{r['pool']:>4}  {r['files']:>5}  {r['failed']:>6}  {r['messages']:>8}  {r['seconds']:>7.2f}  {r['files_per_sec']:>9.1f}  {r['msgs_per_sec']:>8.0f}")
+		return reports
+
+if __name__ == '__main__':
+	main()
\ No newline at end of file